@@ -0,0 +1,172 @@
+import json
+import time
+from collections import Counter
+
+CATALOG_KEY = 'catalog'
+CART_KEY = 'cart'
+GEOCODE_KEY = 'geocode'
+PHOTO_KEY = 'photo'
+PROFILE_KEY = 'profile'
+VERSION_CHECK_PERIOD = 30
+
+
+class CatalogCache(object):
+
+    def __init__(self, ttl, redis_conn=None, version_check_period=VERSION_CHECK_PERIOD):
+        self.ttl = ttl
+        self.redis_conn = redis_conn
+        self.version_check_period = version_check_period
+        self.version, self.version_checked_at = 0, 0
+        self.entries = {}
+
+    def get_version(self):
+        if not self.redis_conn:
+            return self.version
+        if time.monotonic() - self.version_checked_at > self.version_check_period:
+            self.version = int(self.redis_conn.get_value(CATALOG_KEY, 'version') or 0)
+            self.version_checked_at = time.monotonic()
+        return self.version
+
+    def get(self, key):
+        version = self.get_version()
+        entry = self.entries.get(key)
+        if (not entry or entry[0] != version) and self.redis_conn:
+            cached_entry = self.redis_conn.get_value(f'{CATALOG_KEY}:{version}', key)
+            if cached_entry:
+                expires, value = json.loads(cached_entry)
+                entry = self.entries[key] = (version, expires, value)
+        if not entry or entry[0] != version or entry[1] < time.time():
+            return None
+        return entry[2]
+
+    def set(self, key, value):
+        version, expires = self.get_version(), time.time() + self.ttl
+        self.entries[key] = (version, expires, value)
+        if self.redis_conn:
+            catalog_name = f'{CATALOG_KEY}:{version}'
+            self.redis_conn.add_value(catalog_name, key, json.dumps([expires, value]))
+            self.redis_conn.set_expire(catalog_name, self.ttl)
+        return value
+
+    def invalidate(self):
+        if self.redis_conn:
+            self.version = self.redis_conn.increment_value(CATALOG_KEY, 'version')
+            self.version_checked_at = time.monotonic()
+        else:
+            self.version += 1
+        self.entries.clear()
+
+
+class SnapshotCache(object):
+
+    def __init__(self, key, ttl, redis_conn=None):
+        self.key = key
+        self.ttl = ttl
+        self.redis_conn = redis_conn
+        self.snapshots = {}
+
+    def get(self, snapshot_id):
+        if not self.redis_conn:
+            return self.snapshots.get(str(snapshot_id))
+        snapshot = self.redis_conn.get_string(f'{self.key}:{snapshot_id}:snapshot')
+        return json.loads(snapshot) if snapshot else None
+
+    def set(self, snapshot_id, snapshot):
+        if not snapshot:
+            self.delete(snapshot_id)
+        elif self.redis_conn:
+            self.redis_conn.set_string(f'{self.key}:{snapshot_id}:snapshot', json.dumps(snapshot), self.ttl)
+        else:
+            self.snapshots[str(snapshot_id)] = snapshot
+        return snapshot
+
+    def delete(self, snapshot_id):
+        if self.redis_conn:
+            self.redis_conn.del_value(f'{self.key}:{snapshot_id}:snapshot')
+        else:
+            self.snapshots.pop(str(snapshot_id), None)
+
+
+class CartMirror(SnapshotCache):
+
+    def __init__(self, ttl, redis_conn=None):
+        super().__init__(CART_KEY, ttl, redis_conn)
+
+
+class ProfileCache(SnapshotCache):
+
+    def __init__(self, ttl, redis_conn=None):
+        super().__init__(PROFILE_KEY, ttl, redis_conn)
+
+
+class PhotoCache(object):
+
+    def __init__(self, redis_conn=None):
+        self.redis_conn = redis_conn
+        self.photos = {}
+
+    def get(self, product_id, image_id):
+        if self.redis_conn:
+            photo = self.redis_conn.get_value(PHOTO_KEY, product_id)
+            photo = json.loads(photo) if photo else None
+        else:
+            photo = self.photos.get(str(product_id))
+        if not photo or photo['image_id'] != image_id:
+            return None
+        return photo['file_id']
+
+    def set(self, product_id, image_id, file_id):
+        photo = {'image_id': image_id, 'file_id': file_id}
+        if self.redis_conn:
+            self.redis_conn.add_value(PHOTO_KEY, product_id, json.dumps(photo))
+        else:
+            self.photos[str(product_id)] = photo
+
+    def delete(self, product_id):
+        if self.redis_conn:
+            self.redis_conn.del_key(PHOTO_KEY, product_id)
+        else:
+            self.photos.pop(str(product_id), None)
+
+
+class GeocodeCache(object):
+
+    def __init__(self, positive_ttl, negative_ttl, coordinates_precision, redis_conn=None):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.coordinates_precision = coordinates_precision
+        self.redis_conn = redis_conn
+        self.entries = {}
+        self.stats = Counter()
+
+    def get_coordinates_key(self, longitude, latitude):
+        return '%.*f,%.*f' % (
+            self.coordinates_precision, float(longitude),
+            self.coordinates_precision, float(latitude)
+        )
+
+    def get(self, kind, key):
+        if self.redis_conn:
+            cached_value = self.redis_conn.get_string(f'{GEOCODE_KEY}:{kind}:{key}')
+            found, value = cached_value is not None, json.loads(cached_value) if cached_value else None
+        else:
+            entry = self.entries.get((kind, key))
+            found = bool(entry) and entry[0] > time.time()
+            value = entry[1] if found else None
+            if entry and not found:
+                del self.entries[(kind, key)]
+        self.count(kind, 'hits' if found else 'misses')
+        return found, value
+
+    def set(self, kind, key, value):
+        ttl = self.positive_ttl if value else self.negative_ttl
+        if self.redis_conn:
+            self.redis_conn.set_string(f'{GEOCODE_KEY}:{kind}:{key}', json.dumps(value), ttl)
+        else:
+            self.entries[(kind, key)] = [time.time() + ttl, value]
+        return value
+
+    def count(self, kind, result):
+        self.stats[f'{kind}_{result}'] += 1
+        if self.redis_conn:
+            self.redis_conn.increment_value(f'{GEOCODE_KEY}:stats', f'{kind}_{result}')
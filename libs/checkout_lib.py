@@ -0,0 +1,165 @@
+import json
+import logging
+import threading
+import uuid
+from redis.exceptions import LockError
+
+from libs import motlin_lib
+
+CHECKOUTS_KEY = 'checkouts'
+FAILED_CHECKOUTS_KEY = 'checkouts:failed'
+CHECKOUT_LOCK_TIMEOUT = 60
+CHECKOUT_ATTEMPTS = 10
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+FAILED_RESCAN_PERIOD = 900
+
+logger = logging.getLogger('pizza_delivery_bot')
+
+
+class CheckoutPipeline(object):
+
+    def __init__(self, redis_conn, scheduler, profile_buffer=None):
+        self.redis_conn = redis_conn
+        self.scheduler = scheduler
+        self.profile_buffer = profile_buffer
+
+    def get(self, chat_id):
+        checkout = self.redis_conn.get_all(f'{CHECKOUTS_KEY}:{chat_id}')
+        return {field: json.loads(value) for field, value in checkout.items()} or None
+
+    def save(self, chat_id, fields):
+        self.redis_conn.add_values(
+            f'{CHECKOUTS_KEY}:{chat_id}',
+            {field: json.dumps(value) for field, value in fields.items()}
+        )
+
+    def schedule(self, chat_id, delay=0):
+        self.scheduler.schedule(f'checkout:{chat_id}', 'process_checkout', delay, context=chat_id)
+
+    def get_lock(self, chat_id):
+        return self.redis_conn.get_lock(f'{CHECKOUTS_KEY}:{chat_id}:lock', CHECKOUT_LOCK_TIMEOUT)
+
+    def enqueue(self, chat_id, cash_payment=False):
+        lock = self.get_lock(chat_id)
+        locked = lock.acquire(blocking_timeout=CHECKOUT_LOCK_TIMEOUT)
+        try:
+            checkout = self.get(chat_id)
+            if not checkout or checkout.get('order_id'):
+                checkout = {
+                    'key': uuid.uuid4().hex,
+                    'chat_id': chat_id,
+                    'cash_payment': cash_payment,
+                    'attempts': 0
+                }
+                self.redis_conn.del_value(f'{CHECKOUTS_KEY}:{chat_id}')
+                self.save(chat_id, checkout)
+        finally:
+            if locked:
+                release_lock(lock, chat_id)
+        self.schedule(chat_id)
+        return checkout['key']
+
+    def finish(self, chat_id):
+        if not self.get(chat_id):
+            return
+        self.save(chat_id, {'ship': True, 'delete_cart': True})
+        self.schedule(chat_id)
+
+    def run_steps(self, access_token, checkout, notify):
+        chat_id = checkout['chat_id']
+        if not checkout.get('order_id'):
+            if self.profile_buffer:
+                self.profile_buffer.flush(access_token, chat_id)
+            order_id = None
+            if checkout.get('order_posted'):
+                order_id = motlin_lib.find_order(access_token, chat_id, checkout['key'])
+            if not order_id:
+                self.save(chat_id, {'order_posted': True})
+                order_id = motlin_lib.create_order(access_token, chat_id, checkout['key'])
+            checkout['order_id'] = order_id
+            self.save(chat_id, {'order_id': order_id})
+        if not checkout.get('transaction_id'):
+            checkout['transaction_id'] = motlin_lib.set_order_payment(access_token, checkout['order_id'])
+            self.save(chat_id, {'transaction_id': checkout['transaction_id']})
+        if not checkout.get('captured'):
+            motlin_lib.confirm_order_payment(access_token, checkout['order_id'], checkout['transaction_id'])
+            self.save(chat_id, {'captured': True})
+        if not checkout.get('notified'):
+            notify(chat_id, checkout['order_id'], failed=False)
+            self.save(chat_id, {'notified': True})
+        checkout = self.get(chat_id)
+        if checkout.get('ship') and not checkout.get('shipped'):
+            motlin_lib.confirm_order_shipping(access_token, checkout['order_id'])
+            self.save(chat_id, {'shipped': True})
+        if checkout.get('delete_cart') and not checkout.get('cart_deleted'):
+            motlin_lib.delete_the_cart(access_token, chat_id)
+            self.save(chat_id, {'cart_deleted': True})
+            return True
+        return checkout.get('cart_deleted', False)
+
+    def hold_lock(self, lock, released):
+        while not released.wait(CHECKOUT_LOCK_TIMEOUT / 3):
+            try:
+                lock.reacquire()
+            except Exception as error:
+                logger.warning(f'Не удалось продлить блокировку заказа: {error}')
+                return
+
+    def process(self, access_token, chat_id, notify):
+        lock = self.get_lock(chat_id)
+        if not lock.acquire(blocking=False):
+            self.schedule(chat_id, RETRY_DELAY)
+            return
+        released = threading.Event()
+        threading.Thread(target=self.hold_lock, args=(lock, released), daemon=True).start()
+        try:
+            checkout = self.get(chat_id)
+            if not checkout or 'key' not in checkout:
+                self.redis_conn.del_value(f'{CHECKOUTS_KEY}:{chat_id}')
+                return
+            try:
+                completed = self.run_steps(access_token, checkout, notify)
+            except Exception as error:
+                attempts = checkout['attempts'] + 1
+                self.save(chat_id, {'attempts': attempts})
+                if attempts >= CHECKOUT_ATTEMPTS:
+                    logger.exception(f'Заказ {checkout["key"]} не оформлен после {attempts} попыток: {error}')
+                    self.fail(checkout, notify)
+                    return
+                self.schedule(chat_id, min(RETRY_DELAY * 2 ** attempts, MAX_RETRY_DELAY))
+                return
+            if completed:
+                self.redis_conn.del_value(f'{CHECKOUTS_KEY}:{chat_id}')
+            else:
+                self.save(chat_id, {'attempts': 0})
+        finally:
+            released.set()
+            release_lock(lock, chat_id)
+
+
+    def fail(self, checkout, notify):
+        chat_id = checkout['chat_id']
+        with self.redis_conn.pipeline() as pipeline:
+            pipeline.add_member(FAILED_CHECKOUTS_KEY, chat_id)
+        if not checkout.get('notified') and not checkout.get('failure_notified'):
+            notify(chat_id, checkout.get('order_id'), failed=True)
+            self.save(chat_id, {'failure_notified': True})
+
+    def resume(self, chat_id):
+        with self.redis_conn.pipeline() as pipeline:
+            pipeline.del_member(FAILED_CHECKOUTS_KEY, chat_id)
+        if self.get(chat_id):
+            self.save(chat_id, {'attempts': 0})
+            self.schedule(chat_id)
+
+    def resume_failed(self):
+        for chat_id in self.redis_conn.get_members(FAILED_CHECKOUTS_KEY):
+            self.resume(chat_id)
+
+
+def release_lock(lock, chat_id):
+    try:
+        lock.release()
+    except LockError as error:
+        logger.warning(f'Блокировка заказа {chat_id} истекла до завершения: {error}')
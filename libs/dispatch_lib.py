@@ -0,0 +1,39 @@
+import functools
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DISPATCH_WORKERS = 64
+
+logger = logging.getLogger('pizza_delivery_bot')
+
+
+class ChatDispatcher(object):
+
+    def __init__(self, event_loop, handle_update, workers=DISPATCH_WORKERS):
+        self.event_loop = event_loop
+        self.handle_update = handle_update
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queues = {}
+
+    def submit(self, chat_id, *args):
+        self.event_loop.call_soon_threadsafe(self.enqueue, chat_id, args)
+
+    def enqueue(self, chat_id, args):
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            self.event_loop.create_task(self.consume(chat_id, queue))
+        queue.append(args)
+
+    async def consume(self, chat_id, queue):
+        while queue:
+            args = queue.popleft()
+            try:
+                await self.event_loop.run_in_executor(
+                    self.executor,
+                    functools.partial(self.handle_update, *args)
+                )
+            except Exception as error:
+                logger.exception(f'Ошибка бота: {error}')
+        del self.queues[chat_id]
@@ -1,44 +1,102 @@
-import requests
+import heapq
+import json
+import math
+import re
 from geopy import distance
 
+from libs import cache_lib
+from libs import http_lib
 
-def fetch_coordinates(apikey, place):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    params = {"geocode": place, "apikey": apikey, "format": "json"}
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
+REFINE_CANDIDATES = 2
+GEOCODER_URL = 'https://geocode-maps.yandex.ru/1.x'
+GEOCODER_TIMEOUT = (3.05, 10)
+COORDINATES_PRECISION = 4
+POSITIVE_TTL = 30 * 24 * 3600
+NEGATIVE_TTL = 3600
+ADDRESS_ABBREVIATIONS = {
+    'г': 'город',
+    'обл': 'область',
+    'р-н': 'район',
+    'мкр': 'микрорайон',
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'пл': 'площадь',
+    'наб': 'набережная',
+    'ш': 'шоссе',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+    'кв': 'квартира'
+}
+
+transport = http_lib.HttpTransport({}, GEOCODER_TIMEOUT)
+geocode_cache = cache_lib.GeocodeCache(POSITIVE_TTL, NEGATIVE_TTL, COORDINATES_PRECISION)
+
+
+def initialize_cache(redis_conn, coordinates_precision=COORDINATES_PRECISION):
+    geocode_cache.redis_conn = redis_conn
+    geocode_cache.coordinates_precision = coordinates_precision
+
+
+def normalize_address(place):
+    words = re.sub(r'[.,;:]', ' ', place.lower().replace('ё', 'е')).split()
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def fetch_geo_object(apikey, geocode):
+    params = {"geocode": geocode, "apikey": apikey, "format": "json"}
+    response = transport.get(GEOCODER_URL, params=params)
     places_found = response.json()['response']['GeoObjectCollection']['featureMember']
     if places_found:
-        most_relevant = places_found[0]
-        lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
-        return float(lon), float(lat)
+        return places_found[0]['GeoObject']
+
+
+def fetch_reverse_geo_object(apikey, longitude, latitude):
+    coordinates_key = geocode_cache.get_coordinates_key(longitude, latitude)
+    found, geo_object = geocode_cache.get('reverse', coordinates_key)
+    if not found:
+        geo_object = geocode_cache.set(
+            'reverse', coordinates_key,
+            fetch_geo_object(apikey, f'{longitude},{latitude}')
+        )
+    return geo_object
+
+
+def fetch_coordinates(apikey, place):
+    address_key = normalize_address(place)
+    found, coordinates = geocode_cache.get('forward', address_key)
+    if not found:
+        most_relevant = fetch_geo_object(apikey, place)
+        coordinates = geocode_cache.set(
+            'forward', address_key,
+            [float(coordinate) for coordinate in most_relevant['Point']['pos'].split(" ")] if most_relevant else None
+        )
+    if coordinates:
+        lon, lat = coordinates
+        return lon, lat
     else:
         return None, None
 
 
 def fetch_address(apikey, longitude, latitude):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    params = {"geocode": f'{longitude},{latitude}', "apikey": apikey, "format": "json"}
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
-    places_found = response.json()['response']['GeoObjectCollection']['featureMember']
-    if places_found:
-        most_relevant = places_found[0]
-        return most_relevant['GeoObject']['name']
+    most_relevant = fetch_reverse_geo_object(apikey, longitude, latitude)
+    if most_relevant:
+        return most_relevant['name']
 
 
 def fetch_address_decryption(apikey, longitude, latitude):
     address_decryption = {'CountryName': '-', 'AdministrativeAreaName': '-', 'LocalityName': '-'}
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    params = {"geocode": f'{longitude},{latitude}', "apikey": apikey, "format": "json"}
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
-
-    places_found = response.json()['response']['GeoObjectCollection']['featureMember']
-    if not places_found:
+    most_relevant = fetch_reverse_geo_object(apikey, longitude, latitude)
+    if not most_relevant:
         return address_decryption
 
-    for key, value in get_value(places_found[0]):
+    for key, value in get_value(most_relevant):
         if key not in address_decryption.keys():
             continue
         address_decryption[key] = value
@@ -48,7 +106,7 @@ def fetch_address_decryption(apikey, longitude, latitude):
 
 def calculate_distance(addresses, longitude, latitude):
     for address in addresses:
-        address['distance'] = distance.distance((longitude, latitude), (address['longitude'], address['latitude'])).km
+        address['distance'] = distance.distance((latitude, longitude), (address['latitude'], address['longitude'])).km
 
 
 def get_value(address_structure):
@@ -57,3 +115,69 @@ def get_value(address_structure):
             yield from get_value(value)
         else:
             yield key, value
+
+
+def to_cartesian(longitude, latitude):
+    longitude, latitude = math.radians(float(longitude)), math.radians(float(latitude))
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude)
+    )
+
+
+def get_fingerprint(addresses):
+    return hash(json.dumps(addresses, sort_keys=True))
+
+
+class SpatialIndex(object):
+
+    def __init__(self, addresses=()):
+        self.tree, self.fingerprint, self.size = None, None, 0
+        self.rebuild(addresses)
+
+    def rebuild(self, addresses):
+        addresses = list(addresses)
+        nodes = [
+            (to_cartesian(address['longitude'], address['latitude']), number, address)
+            for number, address in enumerate(addresses)
+        ]
+        self.tree, self.fingerprint, self.size = self.build(nodes), get_fingerprint(addresses), len(addresses)
+
+    def build(self, nodes, depth=0):
+        if not nodes:
+            return None
+        axis = depth % 3
+        nodes.sort(key=lambda node: node[0][axis])
+        median = len(nodes) // 2
+        return (
+            nodes[median], axis,
+            self.build(nodes[:median], depth + 1),
+            self.build(nodes[median + 1:], depth + 1)
+        )
+
+    def search(self, tree, target, candidates_number, found):
+        if tree is None:
+            return
+        (coordinates, number, address), axis, left, right = tree
+        squared_chord = sum((target[axis_number] - coordinates[axis_number]) ** 2 for axis_number in range(3))
+        if len(found) < candidates_number:
+            heapq.heappush(found, (-squared_chord, number, address))
+        elif squared_chord < -found[0][0]:
+            heapq.heapreplace(found, (-squared_chord, number, address))
+        axis_offset = target[axis] - coordinates[axis]
+        near, far = (left, right) if axis_offset < 0 else (right, left)
+        self.search(near, target, candidates_number, found)
+        if len(found) < candidates_number or axis_offset ** 2 < -found[0][0]:
+            self.search(far, target, candidates_number, found)
+
+    def nearest(self, longitude, latitude, k=1):
+        found = []
+        self.search(self.tree, to_cartesian(longitude, latitude), k + REFINE_CANDIDATES, found)
+        candidates = [
+            dict(address, distance=distance.distance(
+                (latitude, longitude), (address['latitude'], address['longitude'])
+            ).km)
+            for _, _, address in found
+        ]
+        return sorted(candidates, key=lambda address: address['distance'])[:k]
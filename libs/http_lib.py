@@ -0,0 +1,55 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS'])
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpTransport(object):
+
+    def __init__(self, timeouts, default_timeout, pool_connections=10,
+                 pool_maxsize=20, retries=3, backoff_factor=0.3):
+        self.timeouts = timeouts
+        self.default_timeout = default_timeout
+        self.pool_maxsize = pool_maxsize
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            method_whitelist=IDEMPOTENT_METHODS,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry,
+            pool_block=True
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_timeout(self, url):
+        for url_prefix in sorted(self.timeouts, key=len, reverse=True):
+            if url.startswith(url_prefix):
+                return self.timeouts[url_prefix]
+        return self.default_timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.get_timeout(url))
+        response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
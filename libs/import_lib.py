@@ -0,0 +1,368 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+from contextlib import contextmanager
+from slugify import slugify
+from urllib.parse import urlparse
+
+from libs import motlin_async_lib
+
+IMPORT_WORKERS = 10
+IMPORT_RPS = 20
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+
+class RateLimiter(object):
+
+    def __init__(self, rps):
+        self.interval = 1 / rps if rps else 0
+        self.next_time = 0
+
+    async def wait(self, requests=1):
+        loop = asyncio.get_running_loop()
+        for _ in range(requests):
+            now = loop.time()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+            if start_time > now:
+                await asyncio.sleep(start_time - now)
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+
+    @contextmanager
+    def measure(self, stage):
+        start_time = time.monotonic()
+        yield
+        count, duration = self.stages.get(stage, (0, 0))
+        self.stages[stage] = (count + 1, duration + time.monotonic() - start_time)
+
+    def get_report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return '\n'.join(
+            f'{stage}: {count} за {elapsed:.1f} с ({count / elapsed:.1f}/с, в среднем {duration / count:.2f} с)'
+            for stage, (count, duration) in self.stages.items()
+        )
+
+
+class ImageManifest(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.images = {}
+        if file_name and os.path.exists(file_name):
+            with open(file_name, 'r') as file_handler:
+                self.images = json.load(file_handler)
+        self.file_ids = {image['hash']: image['file_id'] for image in self.images.values()}
+        self.uploads = {}
+
+    def get(self, image_url):
+        return self.images.get(image_url, {})
+
+    def get_file_id(self, image_hash):
+        return self.file_ids.get(image_hash)
+
+    def add(self, image_url, etag, image_hash, file_id):
+        self.images[image_url] = {'etag': etag, 'hash': image_hash, 'file_id': file_id}
+        self.file_ids[image_hash] = file_id
+
+    def save(self):
+        if not self.file_name:
+            return
+        with open(self.file_name, 'w') as file_handler:
+            json.dump(self.images, file_handler, ensure_ascii=False, indent=2)
+
+
+class ImportManifest(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.sections = {}
+        if file_name and os.path.exists(file_name):
+            with open(file_name, 'r') as file_handler:
+                self.sections = json.load(file_handler)
+
+    def get_section(self, section):
+        return self.sections.setdefault(section, {})
+
+    def set(self, section, key, fingerprint):
+        self.get_section(section)[str(key)] = fingerprint
+
+    def remove(self, section, key):
+        self.get_section(section).pop(str(key), None)
+
+    def save(self):
+        if not self.file_name:
+            return
+        with open(self.file_name, 'w') as file_handler:
+            json.dump(self.sections, file_handler, ensure_ascii=False, indent=2)
+
+
+def get_fingerprint(record):
+    return hashlib.sha256(json.dumps(record, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def make_import_plan(records, live_ids, fingerprints, delete=False):
+    import_plan = {'create': [], 'update': [], 'unchanged': [], 'delete': []}
+    for key, record in records.items():
+        if key not in live_ids:
+            import_plan['create'].append(key)
+        elif fingerprints.get(key) != get_fingerprint(record):
+            import_plan['update'].append(key)
+        else:
+            import_plan['unchanged'].append(key)
+    if delete:
+        import_plan['delete'] = [key for key in live_ids if key not in records]
+    return import_plan
+
+
+def get_changes_count(import_plan):
+    return len(import_plan['create']) + len(import_plan['update']) + len(import_plan['delete'])
+
+
+def format_import_plan(title, import_plan):
+    return (
+        f'{title}: создать {len(import_plan["create"])}, обновить {len(import_plan["update"])}, '
+        f'без изменений {len(import_plan["unchanged"])}, удалить {len(import_plan["delete"])}'
+    )
+
+
+def read_image(response):
+    image, image_hash = io.BytesIO(), hashlib.sha256()
+    for chunk in response.iter_content(IMAGE_CHUNK_SIZE):
+        image_hash.update(chunk)
+        image.write(chunk)
+    response.close()
+    image.seek(0)
+    return image, image_hash.hexdigest()
+
+
+def get_main_image_id(product):
+    main_image = product.get('relationships', {}).get('main_image', {}).get('data')
+    return main_image['id'] if main_image else None
+
+
+def get_product_characteristic(product):
+    return {
+        'type': 'product',
+        'name': product['name'],
+        'slug': slugify(product['name']),
+        'sku': str(product['id']),
+        'description': product['description'],
+        'manage_stock': False,
+        'price': [
+            {
+                'amount': product['price'],
+                'currency': 'RUB',
+                'includes_tax': True
+            }
+        ],
+        'status': 'live',
+        'commodity_type': 'physical'
+    }
+
+
+async def upload_image(access_token, image_url, image, limiter, stats):
+    await limiter.wait()
+    with stats.measure('Выгрузка изображений'):
+        return await motlin_async_lib.upload_file(
+            access_token, urlparse(image_url).path.split('/')[-1], image
+        )
+
+
+async def transfer_image(access_token, product_id, image_url, image_id, manifest, limiter, stats):
+    known_image = manifest.get(image_url)
+    headers = {'If-None-Match': known_image['etag']} if known_image.get('etag') else {}
+    with stats.measure('Скачивание изображений'):
+        response = await motlin_async_lib.execute_request('GET', image_url, headers=headers, stream=True)
+        if response.status_code == 304:
+            response.close()
+            image, image_hash = None, known_image['hash']
+        else:
+            image, image_hash = await asyncio.get_running_loop().run_in_executor(
+                motlin_async_lib.executor, read_image, response
+            )
+    etag = response.headers.get('ETag') or known_image.get('etag')
+    file_id = manifest.get_file_id(image_hash)
+    if not file_id:
+        if image_hash not in manifest.uploads:
+            manifest.uploads[image_hash] = asyncio.ensure_future(
+                upload_image(access_token, image_url, image, limiter, stats)
+            )
+        file_id = await manifest.uploads[image_hash]
+    if file_id != image_id:
+        await limiter.wait()
+        with stats.measure('Привязка изображений'):
+            await motlin_async_lib.add_product_image(access_token, product_id, file_id)
+    manifest.add(image_url, etag, image_hash, file_id)
+
+
+async def import_product(access_token, product, catalog, manifest, import_manifest, semaphore, limiter, stats):
+    async with semaphore:
+        product_characteristic = get_product_characteristic(product)
+        product_id, image_id = catalog.get(product_characteristic['sku'], (None, None))
+        await limiter.wait()
+        with stats.measure('Запись продуктов'):
+            if product_id:
+                await motlin_async_lib.update_product(access_token, product_id, product_characteristic)
+            else:
+                product_id = await motlin_async_lib.add_new_product(access_token, product_characteristic)
+        catalog[product_characteristic['sku']] = (product_id, image_id)
+        if product['product_image']['url']:
+            await transfer_image(
+                access_token, product_id, product['product_image']['url'],
+                image_id, manifest, limiter, stats
+            )
+        import_manifest.set('products', product_characteristic['sku'], get_fingerprint(product))
+
+
+async def delete_product(access_token, sku, catalog, import_manifest, semaphore, limiter, stats):
+    async with semaphore:
+        await limiter.wait()
+        with stats.measure('Удаление продуктов'):
+            await motlin_async_lib.delete_product(access_token, catalog.pop(sku)[0])
+        import_manifest.remove('products', sku)
+
+
+def read_models_cache(file_name, models_hash):
+    if not file_name or not os.path.exists(file_name):
+        return None
+    with open(file_name, 'r') as file_handler:
+        models_cache = json.load(file_handler)
+    return models_cache['models'] if models_cache.get('hash') == models_hash else None
+
+
+def save_models_cache(file_name, models_hash, models):
+    if not file_name:
+        return
+    with open(file_name, 'w') as file_handler:
+        json.dump({'hash': models_hash, 'models': models}, file_handler, ensure_ascii=False, indent=2)
+
+
+async def sync_model(access_token, model, flows):
+    model_ids = {'flow_id': '', 'flow_slug': '', 'fields': {}}
+    flow_id = flows.get(model['flow']['name'])
+    if not flow_id:
+        flow_id = await motlin_async_lib.add_new_flow(
+            access_token,
+            model['flow']['name'],
+            model['flow']['slug'],
+            model['flow']['description']
+        )
+        existing_fields = {}
+    else:
+        existing_fields = {
+            field['slug']: field['id']
+            for field in await motlin_async_lib.get_items(access_token, 'fields', model['flow']['slug'])
+        }
+    if not flow_id:
+        return model_ids
+    model_ids['flow_id'], model_ids['flow_slug'] = flow_id, model['flow']['slug']
+    missing_fields = [field for field in model['fields'] if field['slug'] not in existing_fields]
+    field_ids = await asyncio.gather(*[
+        motlin_async_lib.add_new_field(access_token, flow_id, field)
+        for field in missing_fields
+    ])
+    existing_fields.update(zip([field['slug'] for field in missing_fields], field_ids))
+    model_ids['fields'] = {field['name']: existing_fields[field['slug']] for field in model['fields']}
+    return model_ids
+
+
+async def sync_models(access_token, models_catalog):
+    flows = {
+        flow['name']: flow['id']
+        for flow in await motlin_async_lib.get_items(access_token, 'flows')
+    }
+    return await asyncio.gather(*[
+        sync_model(access_token, model, flows)
+        for model in models_catalog
+    ])
+
+
+async def get_products_catalog(access_token, stats):
+    with stats.measure('Чтение каталога'):
+        return {
+            item['sku']: (item['id'], get_main_image_id(item))
+            for item in await motlin_async_lib.get_items(access_token, 'products')
+        }
+
+
+async def run_with_progress(coroutines, progress=None):
+
+    async def run_coroutine(coroutine):
+        await coroutine
+        if progress:
+            progress.update()
+
+    results = await asyncio.gather(
+        *[run_coroutine(coroutine) for coroutine in coroutines],
+        return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+
+async def get_entry_ids(access_token, slug, field, stats):
+    with stats.measure('Чтение записей'):
+        return {
+            str(entry[field]): entry['id']
+            for entry in await motlin_async_lib.get_items(access_token, 'entries', slug)
+            if entry.get(field) is not None
+        }
+
+
+async def upsert_entry(access_token, slug, field, entry, entry_ids, semaphore, limiter, stats):
+    async with semaphore:
+        await limiter.wait()
+        entry_id = entry_ids.get(str(entry[field]))
+        with stats.measure('Запись адресов'):
+            if entry_id:
+                await motlin_async_lib.update_entry(access_token, slug, entry_id, entry)
+            else:
+                entry_id = await motlin_async_lib.add_new_entry(access_token, slug, entry)
+        entry_ids[str(entry[field])] = entry_id
+
+
+async def delete_entry(access_token, slug, value, entry_ids, semaphore, limiter, stats):
+    async with semaphore:
+        await limiter.wait()
+        with stats.measure('Удаление адресов'):
+            await motlin_async_lib.delete_entry(access_token, slug, entry_ids.pop(str(value)))
+
+
+async def upsert_entries(access_token, slug, field, entries, deleted_values, entry_ids, stats,
+                         workers=IMPORT_WORKERS, rps=IMPORT_RPS, progress=None):
+    semaphore, limiter = asyncio.Semaphore(workers), RateLimiter(rps)
+    await run_with_progress(
+        [
+            upsert_entry(access_token, slug, field, entry, entry_ids, semaphore, limiter, stats)
+            for entry in entries
+        ] + [
+            delete_entry(access_token, slug, value, entry_ids, semaphore, limiter, stats)
+            for value in deleted_values
+        ],
+        progress
+    )
+
+
+async def import_products(access_token, products, deleted_skus, catalog, manifest, import_manifest,
+                          stats, workers=IMPORT_WORKERS, rps=IMPORT_RPS, progress=None):
+    semaphore, limiter = asyncio.Semaphore(workers), RateLimiter(rps)
+    await run_with_progress(
+        [
+            import_product(access_token, product, catalog, manifest, import_manifest, semaphore, limiter, stats)
+            for product in products
+        ] + [
+            delete_product(access_token, sku, catalog, import_manifest, semaphore, limiter, stats)
+            for sku in deleted_skus
+        ],
+        progress
+    )
@@ -0,0 +1,78 @@
+import time
+
+INDEX_KEY = 'index'
+INDEX_COMPLETE_KEY = 'index:complete'
+INDEX_COMPLETE_TTL = 60
+INDEXED_FIELDS = {
+    'products': ('sku',),
+    'customers': ('email',),
+    'flows': ('name', 'slug'),
+    'fields': ('slug',),
+    'entries': ('customerid', 'address', 'telegramid')
+}
+
+
+def get_collection_name(item_type, slug=None):
+    return f'{item_type}:{slug}' if slug else item_type
+
+
+def get_indexed_fields(item_type, field):
+    return set(INDEXED_FIELDS.get(item_type, ())) | {field}
+
+
+class ItemIndex(object):
+
+    def __init__(self, redis_conn=None, complete_ttl=INDEX_COMPLETE_TTL):
+        self.redis_conn = redis_conn
+        self.complete_ttl = complete_ttl
+        self.items = {}
+        self.completed = {}
+
+    def get(self, collection, field, value):
+        index_name = f'{INDEX_KEY}:{collection}:{field}'
+        if self.redis_conn:
+            return self.redis_conn.get_value(index_name, str(value))
+        return self.items.get(index_name, {}).get(str(value))
+
+    def add(self, collection, field, value, item_id):
+        self.add_items(collection, [{'id': item_id, field: value}], fields=(field,))
+
+    def add_items(self, collection, items, fields=None):
+        item_type = collection.split(':')[0]
+        for field in fields or INDEXED_FIELDS.get(item_type, ()):
+            index_name = f'{INDEX_KEY}:{collection}:{field}'
+            mapping = {
+                str(item[field]): item['id'] for item in items
+                if item.get(field) is not None and item.get('id')
+            }
+            if self.redis_conn:
+                self.redis_conn.add_values(index_name, mapping)
+            else:
+                self.items.setdefault(index_name, {}).update(mapping)
+
+    def remove(self, collection, field, value):
+        index_name = f'{INDEX_KEY}:{collection}:{field}'
+        if self.redis_conn:
+            self.redis_conn.del_key(index_name, str(value))
+        else:
+            self.items.get(index_name, {}).pop(str(value), None)
+
+    def mark_complete(self, collection, fields):
+        completed = {f'{collection}:{field}': time.time() for field in fields}
+        if self.redis_conn:
+            self.redis_conn.add_values(INDEX_COMPLETE_KEY, completed)
+        else:
+            self.completed.update(completed)
+
+    def mark_incomplete(self, collection, field):
+        if self.redis_conn:
+            self.redis_conn.del_key(INDEX_COMPLETE_KEY, f'{collection}:{field}')
+        else:
+            self.completed.pop(f'{collection}:{field}', None)
+
+    def is_complete(self, collection, field):
+        if self.redis_conn:
+            completed = self.redis_conn.get_value(INDEX_COMPLETE_KEY, f'{collection}:{field}')
+        else:
+            completed = self.completed.get(f'{collection}:{field}')
+        return bool(completed) and time.time() - float(completed) < self.complete_ttl
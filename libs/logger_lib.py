@@ -1,19 +1,91 @@
 import logging
+import queue
+import threading
+import time
 import telegram
 
+MESSAGE_LIMIT = 4096
+QUEUE_SIZE = 1000
+FLUSH_PERIOD = 2
+DEDUPLICATION_PERIOD = 300
+
 
 class NotificationLogHandler(logging.Handler):
 
-    def __init__(self, token, chat_id):
+    def __init__(self, token, chat_id, queue_size=QUEUE_SIZE, flush_period=FLUSH_PERIOD,
+                 deduplication_period=DEDUPLICATION_PERIOD):
         super().__init__()
-        self.token = token
+        self.bot = telegram.Bot(token=token)
         self.chat_id = chat_id
+        self.flush_period = flush_period
+        self.deduplication_period = deduplication_period
+        self.log_entries = queue.Queue(maxsize=queue_size)
+        self.sent_entries = {}
+        self.dropped_entries = 0
+        threading.Thread(target=self.send_periodically, daemon=True).start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        if log_entry:
-            bot = telegram.Bot(token=self.token)
-            bot.sendMessage(chat_id=self.chat_id, text=log_entry)
+        try:
+            log_entry = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if not log_entry:
+            return
+        try:
+            self.log_entries.put_nowait(log_entry)
+        except queue.Full:
+            self.dropped_entries += 1
+
+    def collect_entries(self):
+        log_entries = [self.log_entries.get()]
+        flush_time = time.time() + self.flush_period
+        while time.time() < flush_time:
+            try:
+                log_entries.append(self.log_entries.get(timeout=flush_time - time.time()))
+            except queue.Empty:
+                break
+        return log_entries
+
+    def deduplicate_entries(self, log_entries):
+        now = time.time()
+        self.sent_entries = {
+            log_entry: sent_time for log_entry, sent_time in self.sent_entries.items()
+            if now - sent_time < self.deduplication_period
+        }
+        unique_entries, repeats = [], {}
+        for log_entry in log_entries:
+            if log_entry in self.sent_entries:
+                repeats[log_entry] = repeats.get(log_entry, 0) + 1
+                continue
+            self.sent_entries[log_entry] = now
+            unique_entries.append(log_entry)
+        if repeats:
+            unique_entries.append(f'Повторных сообщений пропущено: {sum(repeats.values())}')
+        if self.dropped_entries:
+            unique_entries.append(f'Сообщений отброшено из-за переполнения очереди: {self.dropped_entries}')
+            self.dropped_entries = 0
+        return unique_entries
+
+    def split_messages(self, log_entries):
+        messages = ['']
+        for log_entry in log_entries:
+            for start in range(0, len(log_entry), MESSAGE_LIMIT):
+                part = log_entry[start:start + MESSAGE_LIMIT]
+                if len(messages[-1]) + len(part) + 2 > MESSAGE_LIMIT:
+                    messages.append(part)
+                else:
+                    messages[-1] = f'{messages[-1]}\n\n{part}' if messages[-1] else part
+        return [message for message in messages if message]
+
+    def send_periodically(self):
+        while True:
+            log_entries = self.deduplicate_entries(self.collect_entries())
+            for message in self.split_messages(log_entries):
+                try:
+                    self.bot.sendMessage(chat_id=self.chat_id, text=message)
+                except Exception:
+                    time.sleep(self.flush_period)
 
 
 def initialize_logger(logger, log_token, chat_id):
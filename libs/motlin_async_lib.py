@@ -0,0 +1,610 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from libs import http_lib
+
+MOTLIN_POOL_SIZE = 20
+MOTLIN_TIMEOUTS = {
+    'https://api.moltin.com/oauth': (3.05, 10),
+    'https://api.moltin.com/v2/files': (3.05, 60),
+    'https://api.moltin.com/v2/carts': (3.05, 10),
+    'https://api.moltin.com/v2/orders': (3.05, 20)
+}
+DEFAULT_TIMEOUT = (3.05, 15)
+
+ITEM_URLS = {
+    'products': 'https://api.moltin.com/v2/products',
+    'customers': 'https://api.moltin.com/v2/customers',
+    'flows': 'https://api.moltin.com/v2/flows',
+    'fields': 'https://api.moltin.com/v2/flows/%s/fields',
+    'entries': 'https://api.moltin.com/v2/flows/%s/entries'
+}
+FILTERABLE_ITEMS = ('products', 'customers')
+PAGE_LIMIT = 100
+
+transport = http_lib.HttpTransport(
+    MOTLIN_TIMEOUTS, DEFAULT_TIMEOUT,
+    pool_maxsize=MOTLIN_POOL_SIZE
+)
+executor = ThreadPoolExecutor(max_workers=MOTLIN_POOL_SIZE)
+
+event_loop = None
+event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global event_loop
+    with event_loop_lock:
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            threading.Thread(target=event_loop.run_forever, daemon=True).start()
+    return event_loop
+
+
+def run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+async def execute_request(method, url, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor,
+        functools.partial(transport.request, method, url, **kwargs)
+    )
+
+
+async def execute_get_request(url, headers={}, data={}):
+    response = await execute_request('GET', url, headers=headers, data=data)
+    return response.json()['data']
+
+
+async def get_moltin_access_token(client_secret, client_id):
+    response = await execute_request(
+        'POST',
+        'https://api.moltin.com/oauth/access_token',
+        data={
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials'
+        }
+    )
+    moltin_token = response.json()
+    return moltin_token['access_token'], moltin_token['expires']
+
+
+async def get_items_page(access_token, url, offset=0, params={}):
+    response = await execute_request(
+        'GET', url,
+        headers={'Authorization': access_token},
+        params=dict(params, **{'page[limit]': PAGE_LIMIT, 'page[offset]': offset})
+    )
+    return response.json()
+
+
+async def execute_paginated_request(access_token, url, params={}):
+    first_page = await get_items_page(access_token, url, 0, params)
+    items, pages = first_page['data'], first_page.get('meta', {}).get('page', {}).get('total', 1)
+    next_pages = await asyncio.gather(*[
+        get_items_page(access_token, url, page * PAGE_LIMIT, params)
+        for page in range(1, pages)
+    ])
+    for next_page in next_pages:
+        items.extend(next_page['data'])
+    return items
+
+
+async def get_items(access_token, item_type, slug=None):
+    return await execute_paginated_request(
+        access_token,
+        ITEM_URLS[item_type] % slug if slug else ITEM_URLS[item_type]
+    )
+
+
+async def find_items(access_token, item_type, field, value, slug=None):
+    if item_type in FILTERABLE_ITEMS:
+        return await execute_paginated_request(
+            access_token, ITEM_URLS[item_type],
+            {'filter': f'eq({field},{value})'}
+        )
+    return await get_items(access_token, item_type, slug)
+
+
+def find_item(items, field, value):
+    found_item = [item for item in items if str(item.get(field)) == str(value)]
+    return found_item[0] if found_item else None
+
+
+async def get_item_id(access_token, item_type, **kwargs):
+    found_item = find_item(
+        await find_items(access_token, item_type, kwargs['field'], kwargs['value'], kwargs.get('slug')),
+        kwargs['field'], kwargs['value']
+    )
+    return found_item['id'] if found_item else None
+
+
+async def get_products(access_token, offset=0, limit_products_per_page=0):
+    response = await execute_request(
+        'GET',
+        'https://api.moltin.com/v2/products?page[limit]=%s&page[offset]=%s' % (limit_products_per_page, offset),
+        headers={'Authorization': access_token}
+    )
+    products = response.json()
+    return (
+        products['data'],
+        products['meta']['page']['total'],
+        products['meta']['page']['current']
+    )
+
+
+async def add_new_product(access_token, product_characteristic):
+    response = await execute_request(
+        'POST',
+        'https://api.moltin.com/v2/products',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json={'data': product_characteristic}
+    )
+    return response.json()['data']['id']
+
+
+async def update_product(access_token, product_id, product_characteristic):
+    product_characteristic['id'] = product_id
+    await execute_request(
+        'PUT',
+        f'https://api.moltin.com/v2/products/{product_id}',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json={'data': product_characteristic}
+    )
+
+
+async def delete_product(access_token, product_id):
+    await execute_request(
+        'DELETE',
+        f'https://api.moltin.com/v2/products/{product_id}',
+        headers={'Authorization': access_token}
+    )
+
+
+async def upload_file(access_token, file_name, file_handler):
+    response = await execute_request(
+        'POST',
+        'https://api.moltin.com/v2/files',
+        headers={'Authorization': access_token},
+        files={'file': (file_name, file_handler), 'public': True}
+    )
+    return response.json()['data']['id']
+
+
+async def load_file(access_token, product_id, image_file):
+    with open(image_file, 'rb') as file_handler:
+        file_id = await upload_file(access_token, os.path.basename(image_file), file_handler)
+    await add_product_image(access_token, product_id, file_id)
+
+
+async def get_quantity_product_in_stock(access_token, product_id):
+    product_data = await execute_get_request(
+        f'https://api.moltin.com/v2/inventories/{product_id}',
+        headers={'Authorization': access_token}
+    )
+    return product_data['total']
+
+
+async def get_product_image(access_token, product_data):
+    image_id = product_data['relationships']['main_image']['data']['id']
+    image_data = await execute_get_request(
+        f'https://api.moltin.com/v2/files/{image_id}',
+        headers={'Authorization': access_token}
+    )
+    return image_data['link']['href']
+
+
+async def add_product_image(access_token, product_id, image_id):
+    await execute_request(
+        'POST',
+        f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json={'data': {'type': 'main_image', 'id': image_id}}
+    )
+
+
+async def get_product_info(access_token, product_id):
+    response = await execute_request(
+        'GET',
+        f'https://api.moltin.com/v2/products/{product_id}?include=main_image',
+        headers={'Authorization': access_token}
+    )
+    product = response.json()
+    product_data = product['data']
+    main_images = product.get('included', {}).get('main_images')
+    main_image = product_data.get('relationships', {}).get('main_image', {}).get('data')
+    if main_images:
+        product_image = main_images[0]['link']['href']
+    else:
+        product_image = await get_product_image(access_token, product_data)
+    name, description, currency, amount = (
+        product_data['name'],
+        product_data['description'],
+        product_data['price'][0]['currency'],
+        product_data['price'][0]['amount']
+    )
+    return (
+        f'<b>{name}</b>\n\nстоимость: {amount} {currency}\n\n<i>{description}</i>',
+        product_image,
+        main_image['id'] if main_image else None
+    )
+
+
+async def put_into_cart(access_token, cart_id, prod_id, quantity=1):
+    response = await execute_request(
+        'POST',
+        f'https://api.moltin.com/v2/carts/{cart_id}/items',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json={'data': {'id': prod_id, 'type': 'cart_item', 'quantity': quantity}}
+    )
+    return make_cart_snapshot(response.json())
+
+
+async def delete_from_cart(access_token, cart_id, prod_id):
+    response = await execute_request(
+        'DELETE',
+        f'https://api.moltin.com/v2/carts/{cart_id}/items/{prod_id}',
+        headers={'Authorization': access_token}
+    )
+    return make_cart_snapshot(response.json())
+
+
+async def delete_the_cart(access_token, cart_id):
+    await execute_request(
+        'DELETE',
+        f'https://api.moltin.com/v2/carts/{cart_id}',
+        headers={'Authorization': access_token}
+    )
+
+
+async def get_cart(access_token, cart_id):
+    return await execute_get_request(
+        f'https://api.moltin.com/v2/carts/{cart_id}',
+        headers={'Authorization': access_token}
+    )
+
+
+async def get_cart_items(access_token, cart_id):
+    return await execute_get_request(
+        f'https://api.moltin.com/v2/carts/{cart_id}/items',
+        headers={'Authorization': access_token}
+    )
+
+
+def make_cart_snapshot(cart_items_response):
+    cart_price = cart_items_response.get('meta', {}).get('display_price', {}).get('with_tax')
+    if cart_price:
+        return {'items': cart_items_response['data'], 'price': cart_price}
+
+
+async def get_cart_snapshot(access_token, cart_id):
+    cart_items, cart = await asyncio.gather(
+        get_cart_items(access_token, cart_id),
+        get_cart(access_token, cart_id)
+    )
+    return {'items': cart_items, 'price': cart['meta']['display_price']['with_tax']}
+
+
+def format_cart_info(cart_snapshot):
+    cart_info = []
+    for cart_item in cart_snapshot['items']:
+        name, description, quantity, amount = (
+            cart_item['name'],
+            cart_item['description'],
+            cart_item['quantity'],
+            cart_item['meta']['display_price']['with_tax']['value']['formatted']
+        )
+        cart_info.append(f'<b>{name}</b>\n<i>{description}</i>\n{quantity} шт. на сумму: {amount}')
+    cart_info.append(format_cart_amount(cart_snapshot))
+    return '\n\n'.join(cart_info)
+
+
+def format_cart_amount(cart_snapshot):
+    return 'Всего к оплате: %s' % cart_snapshot['price']['formatted']
+
+
+def format_payment_info(cart_snapshot):
+    cart_info = []
+    for cart_item in cart_snapshot['items']:
+        name, quantity, amount = (
+            cart_item['name'],
+            cart_item['quantity'],
+            cart_item['meta']['display_price']['with_tax']['value']['formatted']
+        )
+        cart_info.append(f'{name} - {quantity} шт. на сумму: {amount}')
+    return (
+        '\n'.join(cart_info),
+        cart_snapshot['price']['currency'],
+        cart_snapshot['price']['amount']
+    )
+
+
+def get_quantity_in_cart_snapshot(cart_snapshot, product_id):
+    quantity_in_cart = [
+        cart_item['quantity'] for cart_item in cart_snapshot['items']
+        if cart_item['id'] == product_id
+    ]
+    return quantity_in_cart[0] if quantity_in_cart else 0
+
+
+async def get_cart_info(access_token, cart_id):
+    return format_cart_info(await get_cart_snapshot(access_token, cart_id))
+
+
+async def get_quantity_product_in_cart(access_token, cart_id, product_id):
+    return get_quantity_in_cart_snapshot(await get_cart_snapshot(access_token, cart_id), product_id)
+
+
+async def get_cart_amount(access_token, cart_id):
+    return format_cart_amount(await get_cart_snapshot(access_token, cart_id))
+
+
+async def get_payment_info(access_token, cart_id):
+    return format_payment_info(await get_cart_snapshot(access_token, cart_id))
+
+
+async def add_new_customer(access_token, email):
+    response = await execute_request(
+        'POST',
+        'https://api.moltin.com/v2/customers',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json={'data': {'type': 'customer', 'name': email.split('@')[0], 'email': email}}
+    )
+    return response.json()['data']['id']
+
+
+async def add_new_flow(access_token, flow_name, flow_slug, flow_description):
+    data = {
+        'data': {
+            'type': 'flow',
+            'name': flow_name,
+            'slug': flow_slug,
+            'description': flow_description,
+            'enabled': True
+        }
+    }
+    response = await execute_request(
+        'POST',
+        'https://api.moltin.com/v2/flows',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+    return response.json()['data']['id']
+
+
+async def update_flow(access_token, flow_id, flow_name, flow_slug, flow_description):
+    data = {
+        'data': {
+            'id': flow_id,
+            'type': 'flow',
+            'name': flow_name,
+            'slug': flow_slug,
+            'description': flow_description,
+            'enabled': True
+        }
+    }
+    await execute_request(
+        'POST',
+        f'https://api.moltin.com/v2/flows/{flow_id}',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+
+
+async def add_new_field(access_token, flow_id, field_characteristics):
+    data = {
+        'data': {
+            'type': 'field',
+            'name': field_characteristics['name'],
+            'slug': field_characteristics['slug'],
+            'description': field_characteristics['description'],
+            'field_type': field_characteristics['type'],
+            'enabled': True,
+            'required': False,
+            'relationships': {
+                'flow': {
+                    'data': {
+                        'type': 'flow',
+                        'id': flow_id
+                    }
+                }
+            }
+        }
+    }
+    response = await execute_request(
+        'POST',
+        'https://api.moltin.com/v2/fields',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+    return response.json()['data']['id']
+
+
+async def add_new_entry(access_token, flow_slug, fields):
+    data = {
+        'data': {
+            'type': 'entry'
+        }
+    }
+    data['data'].update(fields)
+    response = await execute_request(
+        'POST',
+        f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+    return response.json()['data']['id']
+
+
+async def update_entry(access_token, flow_slug, entry_id, fields):
+    data = {
+        'data': {
+            'type': 'entry'
+        }
+    }
+    data['data'].update(fields)
+    response = await execute_request(
+        'PUT',
+        f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+    return response.json()['data']
+
+
+async def delete_entry(access_token, flow_slug, entry_id):
+    await execute_request(
+        'DELETE',
+        f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}',
+        headers={'Authorization': access_token}
+    )
+
+
+async def get_pizzeria_entries(access_token):
+    entries = await get_items(access_token, 'entries', 'pizzeria')
+    return [
+        {'address': entry['address'], 'longitude': entry['longitude'], 'latitude': entry['latitude']}
+        for entry in entries
+    ]
+
+
+async def get_entry(access_token, flow_slug, entry_id):
+    return await execute_get_request(
+        f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}',
+        {'Authorization': access_token}
+    )
+
+
+async def get_customer_info(access_token, customer_id):
+    return await execute_get_request(
+        f'https://api.moltin.com/v2/customers/{customer_id}',
+        {'Authorization': access_token}
+    )
+
+
+async def get_customer(access_token, field, value):
+    return await get_item_id(access_token, 'customers', field=field, value=value)
+
+
+async def get_address(access_token, slug, field, value):
+    return find_item(await get_items(access_token, 'entries', slug), field, value)
+
+
+async def save_address(access_token, slug, field, value, address):
+    entry_id = await get_item_id(access_token, 'entries', slug=slug, field=field, value=value)
+    if entry_id:
+        await update_entry(access_token, slug, entry_id, address)
+    else:
+        await add_new_entry(access_token, slug, address)
+
+
+async def create_order(access_token, chat_id):
+    customer_address = await get_address(access_token, 'customeraddress', 'customerid', str(chat_id))
+    customer_info = find_item(
+        await find_items(access_token, 'customers', 'email', customer_address['email']),
+        'email', customer_address['email']
+    )
+    return await checkout(access_token, chat_id, customer_address, customer_info)
+
+
+async def checkout(access_token, chat_id, customer_address, customer_info, checkout_key=None):
+    data = {
+        'data': {
+            'customer': {
+                'id': customer_info['id']
+            },
+            'billing_address': {
+                'first_name': customer_info['name'],
+                'last_name': customer_info['name'],
+                'line_1': customer_address['address'],
+                'city': customer_address['city'],
+                'postcode': '0000',
+                'county': customer_address['county'],
+                'country': customer_address['country']
+            },
+            'shipping_address': {
+                'first_name': customer_info['name'],
+                'last_name': customer_info['name'],
+                'phone_number': customer_address['telephone'],
+                'line_1': customer_address['address'],
+                'postcode': '0000',
+                'county': customer_address['county'],
+                'country': customer_address['country']
+            }
+        }
+    }
+    if checkout_key:
+        data['data']['shipping_address']['instructions'] = checkout_key
+    response = await execute_request(
+        'POST',
+        f'https://api.moltin.com/v2/carts/{chat_id}/checkout',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+    return response.json()['data']['id']
+
+
+async def find_order(access_token, customer_id, checkout_key):
+    orders = await execute_paginated_request(
+        access_token, 'https://api.moltin.com/v2/orders',
+        {'filter': f'eq(customer_id,{customer_id})'}
+    )
+    found_orders = [
+        order for order in orders
+        if order.get('shipping_address', {}).get('instructions') == checkout_key
+    ]
+    return found_orders[0]['id'] if found_orders else None
+
+
+async def set_order_payment(access_token, order_id):
+    data = {
+        'data': {
+            'gateway': 'manual',
+            'method': 'authorize'
+        }
+    }
+    response = await execute_request(
+        'POST',
+        f'https://api.moltin.com/v2/orders/{order_id}/payments',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+    return response.json()['data']['id']
+
+
+async def confirm_order_payment(access_token, order_id, transaction_id):
+    data = {
+        'data': {
+            'gateway': 'manual',
+            'method': 'capture'
+        }
+    }
+    await execute_request(
+        'POST',
+        f'https://api.moltin.com/v2/orders/{order_id}/transactions/{transaction_id}/capture',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
+
+
+async def confirm_order_shipping(access_token, order_id):
+    if not order_id:
+        return
+    data = {
+        'data': {
+            'type': 'order',
+            'shipping': 'fulfilled'
+        }
+    }
+    await execute_request(
+        'PUT',
+        f'https://api.moltin.com/v2/orders/{order_id}',
+        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
+        json=data
+    )
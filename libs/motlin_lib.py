@@ -1,561 +1,451 @@
-import os
+import hashlib
 import json
 import requests
 from tqdm import tqdm
-from slugify import slugify
-from urllib.parse import urlparse
+
+from libs import cache_lib
+from libs import import_lib
+from libs import index_lib
+from libs import motlin_async_lib
+
+CATALOG_CACHE_TTL = 3600
+CART_MIRROR_TTL = 24 * 3600
+PROFILE_CACHE_TTL = 24 * 3600
+CUSTOMER_ADDRESS_SLUG = 'customeraddress'
+CUSTOMER_ADDRESS_FIELDS = (
+    'address', 'customerid', 'longitude', 'latitude',
+    'telephone', 'email', 'city', 'county', 'country'
+)
+
+catalog_cache = cache_lib.CatalogCache(CATALOG_CACHE_TTL)
+item_index = index_lib.ItemIndex()
+cart_mirror = cache_lib.CartMirror(CART_MIRROR_TTL)
+photo_cache = cache_lib.PhotoCache()
+profile_cache = cache_lib.ProfileCache(PROFILE_CACHE_TTL)
+
+
+def initialize_cache(redis_conn):
+    catalog_cache.redis_conn = redis_conn
+    item_index.redis_conn = redis_conn
+    cart_mirror.redis_conn = redis_conn
+    photo_cache.redis_conn = redis_conn
+    profile_cache.redis_conn = redis_conn
 
 
 def get_moltin_access_token(client_secret, client_id):
-    response = requests.post(
-        'https://api.moltin.com/oauth/access_token',
-        data={
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'grant_type': 'client_credentials'
-        }
-    )
-    response.raise_for_status()
-    moltin_token = response.json()
-    return moltin_token['access_token'], moltin_token['expires']
+    return motlin_async_lib.run(motlin_async_lib.get_moltin_access_token(client_secret, client_id))
 
 
 def execute_get_request(url, headers={}, data={}):
-    response = requests.get(url, headers=headers, data=data)
-    response.raise_for_status()
-    return response.json()['data']
+    return motlin_async_lib.run(motlin_async_lib.execute_get_request(url, headers, data))
 
 
 def get_item_id(access_token, item_type, **kwargs):
-    urls = {
-        'products': 'https://api.moltin.com/v2/products',
-        'customers': 'https://api.moltin.com/v2/customers',
-        'flows': 'https://api.moltin.com/v2/flows',
-        'fields': 'https://api.moltin.com/v2/flows/%s/fields',
-        'entries': 'https://api.moltin.com/v2/flows/%s/entries'
-    }
-    found_items = execute_get_request(
-        urls[item_type] % kwargs['slug'] if kwargs.get('slug') else urls[item_type],
-        {'Authorization': access_token}
+    collection = index_lib.get_collection_name(item_type, kwargs.get('slug'))
+    item_id = item_index.get(collection, kwargs['field'], kwargs['value'])
+    if item_id:
+        return item_id
+    if item_index.is_complete(collection, kwargs['field']):
+        return None
+    found_items = motlin_async_lib.run(
+        motlin_async_lib.find_items(
+            access_token, item_type,
+            kwargs['field'], kwargs['value'], kwargs.get('slug')
+        )
     )
-    found_item = [item['id'] for item in found_items if item[kwargs['field']] == kwargs['value']]
-    return found_item[0] if found_item else None
+    indexed_fields = index_lib.get_indexed_fields(item_type, kwargs['field'])
+    item_index.add_items(collection, found_items, indexed_fields)
+    if item_type not in motlin_async_lib.FILTERABLE_ITEMS:
+        item_index.mark_complete(collection, indexed_fields)
+    found_item = motlin_async_lib.find_item(found_items, kwargs['field'], kwargs['value'])
+    return found_item['id'] if found_item else None
 
 
-def get_products(access_token, offset=0, limit_products_per_page=0):
-    response = requests.get(
-        'https://api.moltin.com/v2/products?page[limit]=%s&page[offset]=%s' % (limit_products_per_page, offset),
-        headers={'Authorization': access_token}
-    )
+def is_not_found(error):
+    return error.response is not None and error.response.status_code == 404
+
+
+def drop_item_id(item_type, **kwargs):
+    collection = index_lib.get_collection_name(item_type, kwargs.get('slug'))
+    item_index.remove(collection, kwargs['field'], kwargs['value'])
+    item_index.mark_incomplete(collection, kwargs['field'])
 
-    response.raise_for_status()
-    products = response.json()
-    return (
-        products['data'],
-        products['meta']['page']['total'],
-        products['meta']['page']['current']
+
+def get_indexed_item(access_token, get_item, item_type, **kwargs):
+    for _ in range(2):
+        item_id = get_item_id(access_token, item_type, **kwargs)
+        if not item_id:
+            return None
+        try:
+            item = get_item(access_token, item_id)
+        except requests.exceptions.HTTPError as error:
+            if not is_not_found(error):
+                raise
+            item = None
+        if item and str(item.get(kwargs['field'])) == str(kwargs['value']):
+            return item
+        drop_item_id(item_type, **kwargs)
+    return None
+
+
+def get_products(access_token, offset=0, limit_products_per_page=0):
+    cache_key = f'products:{offset}:{limit_products_per_page}'
+    products = catalog_cache.get(cache_key)
+    if products:
+        return products
+    return catalog_cache.set(
+        cache_key,
+        motlin_async_lib.run(motlin_async_lib.get_products(access_token, offset, limit_products_per_page))
     )
 
 
 def add_new_product(access_token, product_characteristic):
-    response = requests.post(
-        f'https://api.moltin.com/v2/products',
-        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
-        json={'data': product_characteristic}
-    )
-    response.raise_for_status()
-    return response.json()['data']['id']
+    product_id = motlin_async_lib.run(motlin_async_lib.add_new_product(access_token, product_characteristic))
+    item_index.add('products', 'sku', product_characteristic['sku'], product_id)
+    return product_id
 
 
 def update_product(access_token, product_id, product_characteristic):
-    product_characteristic['id'] = product_id
-    response = requests.put(
-        f'https://api.moltin.com/v2/products/{product_id}',
-        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
-        json={'data': product_characteristic}
-    )
-    response.raise_for_status()
+    motlin_async_lib.run(motlin_async_lib.update_product(access_token, product_id, product_characteristic))
+    item_index.add('products', 'sku', product_characteristic['sku'], product_id)
 
 
 def load_file(access_token, product_id, image_file):
-    response = requests.post(
-        f'https://api.moltin.com/v2/files',
-        headers={'Authorization': access_token},
-        files={'file': open(image_file, 'rb'), 'public': True}
-    )
-    response.raise_for_status()
-    add_product_image(access_token, product_id, response.json()['data']['id'])
+    return motlin_async_lib.run(motlin_async_lib.load_file(access_token, product_id, image_file))
 
 
 def get_quantity_product_in_stock(access_token, product_id):
-    product_data = execute_get_request(
-        f'https://api.moltin.com/v2/inventories/{product_id}',
-        headers={'Authorization': access_token}
-    )
-    return product_data['total']
+    return motlin_async_lib.run(motlin_async_lib.get_quantity_product_in_stock(access_token, product_id))
 
 
 def get_product_image(access_token, product_data):
-    image_id = product_data['relationships']['main_image']['data']['id']
-    product_data = execute_get_request(
-        f'https://api.moltin.com/v2/files/{image_id}',
-        headers={'Authorization': access_token}
+    cache_key = 'image:%s' % product_data['relationships']['main_image']['data']['id']
+    product_image = catalog_cache.get(cache_key)
+    if product_image:
+        return product_image
+    return catalog_cache.set(
+        cache_key,
+        motlin_async_lib.run(motlin_async_lib.get_product_image(access_token, product_data))
     )
-    return product_data['link']['href']
 
 
 def add_product_image(access_token, product_id, image_id):
-    response = requests.post(
-        f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image',
-        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
-        json={'data': {'type': 'main_image', 'id': image_id}}
-    )
-    response.raise_for_status()
+    return motlin_async_lib.run(motlin_async_lib.add_product_image(access_token, product_id, image_id))
 
 
 def get_product_info(access_token, product_id):
-    product_data = execute_get_request(
-        f'https://api.moltin.com/v2/products/{product_id}',
-        headers={'Authorization': access_token}
-    )
-    product_image = get_product_image(access_token, product_data)
-    name, description, currency, amount = (
-        product_data['name'],
-        product_data['description'],
-        product_data['price'][0]['currency'],
-        product_data['price'][0]['amount']
-    )
-    return (
-        f'<b>{name}</b>\n\nстоимость: {amount} {currency}\n\n<i>{description}</i>',
-        product_image
+    cache_key = f'product_card:{product_id}'
+    product_info = catalog_cache.get(cache_key)
+    if product_info:
+        return product_info
+    return catalog_cache.set(
+        cache_key,
+        motlin_async_lib.run(motlin_async_lib.get_product_info(access_token, product_id))
     )
 
 
 def put_into_cart(access_token, cart_id, prod_id, quantity=1):
-    response = requests.post(
-        f'https://api.moltin.com/v2/carts/{cart_id}/items',
-        headers={'Authorization': access_token, 'Content-Type': 'application/json'},
-        json={'data': {'id': prod_id, 'type': 'cart_item', 'quantity': quantity}}
+    cart_mirror.set(
+        cart_id,
+        motlin_async_lib.run(motlin_async_lib.put_into_cart(access_token, cart_id, prod_id, quantity))
     )
-    response.raise_for_status()
 
 
 def delete_from_cart(access_token, cart_id, prod_id):
-    response = requests.delete(
-        f'https://api.moltin.com/v2/carts/{cart_id}/items/{prod_id}',
-        headers={'Authorization': access_token}
+    cart_mirror.set(
+        cart_id,
+        motlin_async_lib.run(motlin_async_lib.delete_from_cart(access_token, cart_id, prod_id))
     )
-    response.raise_for_status()
 
 
 def delete_the_cart(access_token, cart_id):
-    response = requests.delete(
-        f'https://api.moltin.com/v2/carts/{cart_id}',
-        headers={'Authorization': access_token}
+    motlin_async_lib.run(motlin_async_lib.delete_the_cart(access_token, cart_id))
+    cart_mirror.delete(cart_id)
+
+
+def reconcile_cart(access_token, cart_id):
+    return cart_mirror.set(
+        cart_id,
+        motlin_async_lib.run(motlin_async_lib.get_cart_snapshot(access_token, cart_id))
     )
-    response.raise_for_status()
+
+
+def get_cart(access_token, cart_id):
+    return cart_mirror.get(cart_id) or reconcile_cart(access_token, cart_id)
 
 
 def get_cart_items(access_token, cart_id):
-    return execute_get_request(
-        f'https://api.moltin.com/v2/carts/{cart_id}/items',
-        headers={'Authorization': access_token}
-    )
+    return get_cart(access_token, cart_id)['items']
 
 
 def get_cart_info(access_token, cart_id):
-    cart_info = []
-    for cart_item in get_cart_items(access_token, cart_id):
-        name, description, quantity, amount = (
-            cart_item['name'],
-            cart_item['description'],
-            cart_item['quantity'],
-            cart_item['meta']['display_price']['with_tax']['value']['formatted']
-        )
-        cart_info.append(f'<b>{name}</b>\n<i>{description}</i>\n{quantity} шт. на сумму: {amount}')
-    cart_info.append(get_cart_amount(access_token, cart_id))
-    return '\n\n'.join(cart_info)
+    return motlin_async_lib.format_cart_info(get_cart(access_token, cart_id))
 
 
 def get_quantity_product_in_cart(access_token, cart_id, product_id):
-    quantity_in_cart = [cart_item['quantity'] for cart_item in get_cart_items(access_token, cart_id) if cart_item['id'] == product_id]
-    return quantity_in_cart[0] if quantity_in_cart else 0
+    return motlin_async_lib.get_quantity_in_cart_snapshot(get_cart(access_token, cart_id), product_id)
 
 
 def get_cart_amount(access_token, cart_id):
-    cart_price = execute_get_request(
-        f'https://api.moltin.com/v2/carts/{cart_id}',
-        headers={'Authorization': access_token}
-    )
-    return 'Всего к оплате: %s' % cart_price['meta']['display_price']['with_tax']['formatted']
+    return motlin_async_lib.format_cart_amount(get_cart(access_token, cart_id))
 
 
 def get_payment_info(access_token, cart_id):
-    cart_info = []
-    for cart_item in get_cart_items(access_token, cart_id):
-        name, quantity, amount = (
-            cart_item['name'],
-            cart_item['quantity'],
-            cart_item['meta']['display_price']['with_tax']['value']['formatted']
-        )
-        cart_info.append(f'{name} - {quantity} шт. на сумму: {amount}')
-    cart_description = '\n'.join(cart_info)
-    cart_price = execute_get_request(
-        f'https://api.moltin.com/v2/carts/{cart_id}',
-        headers={'Authorization': access_token}
-    )
-    return (
-        cart_description,
-        cart_price['meta']['display_price']['with_tax']['currency'],
-        cart_price['meta']['display_price']['with_tax']['amount']
-    )
+    return motlin_async_lib.format_payment_info(get_cart(access_token, cart_id))
 
 
 def add_new_customer(access_token, email):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {'data': {'type': 'customer', 'name': email.split('@')[0], 'email': email}}
-    response = requests.post(
-        'https://api.moltin.com/v2/customers',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
+    customer_id = motlin_async_lib.run(motlin_async_lib.add_new_customer(access_token, email))
+    item_index.add('customers', 'email', email, customer_id)
+    return customer_id
 
 
 def add_new_flow(access_token, flow_name, flow_slug, flow_description):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'type': 'flow',
-            'name': flow_name,
-            'slug': flow_slug,
-            'description': flow_description,
-            'enabled': True
-        }
-    }
-    response = requests.post(
-        'https://api.moltin.com/v2/flows',
-        headers=headers,
-        json=data
+    flow_id = motlin_async_lib.run(
+        motlin_async_lib.add_new_flow(access_token, flow_name, flow_slug, flow_description)
     )
-    response.raise_for_status()
-    return response.json()['data']['id']
+    item_index.add_items('flows', [{'id': flow_id, 'name': flow_name, 'slug': flow_slug}])
+    return flow_id
 
 
 def update_flow(access_token, flow_id, flow_name, flow_slug, flow_description):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'id': flow_id,
-            'type': 'flow',
-            'name': flow_name,
-            'slug': flow_slug,
-            'description': flow_description,
-            'enabled': True
-        }
-    }
-    response = requests.post(
-        f'https://api.moltin.com/v2/flows/{flow_id}',
-        headers=headers,
-        json=data
+    return motlin_async_lib.run(
+        motlin_async_lib.update_flow(access_token, flow_id, flow_name, flow_slug, flow_description)
     )
-    response.raise_for_status()
 
 
 def add_new_field(access_token, flow_id, field_characteristics):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'type': 'field',
-            'name': field_characteristics['name'],
-            'slug': field_characteristics['slug'],
-            'description': field_characteristics['description'],
-            'field_type': field_characteristics['type'],
-            'enabled': True,
-            'required': False,
-            'relationships': {
-                'flow': {
-                    'data': {
-                        'type': 'flow',
-                        'id': flow_id
-                    }
-                }
-            }
-        }
-    }
-    response = requests.post(
-        'https://api.moltin.com/v2/fields',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
-    return response.json()['data']['id']
+    return motlin_async_lib.run(motlin_async_lib.add_new_field(access_token, flow_id, field_characteristics))
 
 
 def add_new_entry(access_token, flow_slug, fields):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'type': 'entry'
-        }
-    }
-    data['data'].update(fields)
-    response = requests.post(
-        f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
-    return response.json()['data']['id']
+    entry_id = motlin_async_lib.run(motlin_async_lib.add_new_entry(access_token, flow_slug, fields))
+    item_index.add_items(index_lib.get_collection_name('entries', flow_slug), [dict(fields, id=entry_id)])
+    return entry_id
 
 
 def update_entry(access_token, flow_slug, entry_id, fields):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'type': 'entry'
-        }
-    }
-    data['data'].update(fields)
-    response = requests.put(
-        f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
+    entry = motlin_async_lib.run(motlin_async_lib.update_entry(access_token, flow_slug, entry_id, fields))
+    item_index.add_items(index_lib.get_collection_name('entries', flow_slug), [entry])
+    return entry
 
 
 def get_pizzeria_entries(access_token):
-    url = f'https://api.moltin.com/v2/flows/pizzeria/entries'
-    entries = execute_get_request(
-        url,
-        {'Authorization': access_token}
-    )
-    return [{'address': entry['address'], 'longitude': entry['longitude'], 'latitude': entry['latitude']} for entry in entries]
+    return motlin_async_lib.run(motlin_async_lib.get_pizzeria_entries(access_token))
 
 
 def get_entry(access_token, flow_slug, entry_id):
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}'
-    return execute_get_request(
-        url,
-        {'Authorization': access_token}
-    )
+    return motlin_async_lib.run(motlin_async_lib.get_entry(access_token, flow_slug, entry_id))
+
+
+def get_customer_info(access_token, customer_id):
+    return motlin_async_lib.run(motlin_async_lib.get_customer_info(access_token, customer_id))
 
 
 def get_customer(access_token, field, value):
-    return get_item_id(access_token, 'customers', field=field, value=value)
+    customer_info = get_indexed_item(access_token, get_customer_info, 'customers', field=field, value=value)
+    return customer_info['id'] if customer_info else None
 
 
 def get_address(access_token, slug, field, value):
-    entry_id = get_item_id(access_token, 'entries', slug=slug, field=field, value=value)
-    if entry_id:
-        return get_entry(access_token, slug, entry_id)
+    return get_indexed_item(
+        access_token,
+        lambda access_token, entry_id: get_entry(access_token, slug, entry_id),
+        'entries', slug=slug, field=field, value=value
+    )
 
 
-def read_models_from_file(access_token, file_name):
-    models = []
-    with open(file_name, 'r') as file_handler:
-        models_catalog = json.load(file_handler)
+def read_models_from_file(access_token, file_name, cache_file_name=None):
+    with open(file_name, 'rb') as file_handler:
+        models_content = file_handler.read()
+    models_hash = hashlib.sha256(models_content).hexdigest()
 
-    for model in models_catalog:
-        model_ids = {'flow_id': '', 'flow_slug': '', 'fields': {}}
-        flow_id = get_item_id(
-            access_token, 'flows', field='name',
-            value=model['flow']['name']
-        )
-        if not flow_id:
-            flow_id = add_new_flow(
-                access_token,
-                model['flow']['name'],
-                model['flow']['slug'],
-                model['flow']['description']
-            )
-        if flow_id:
-            model_ids['flow_id'], model_ids['flow_slug'] = flow_id, model['flow']['slug']
-        else:
-            models.append(model_ids)
-            continue
-        for field in model['fields']:
-            field_id = get_item_id(
-                access_token,
-                'fields',
-                slug=model['flow']['slug'],
-                field='slug',
-                value=field['slug']
-            )
-            if field_id:
-                model_ids['fields'][field['name']] = field_id
-                continue
-            model_ids['fields'][field['name']] = add_new_field(access_token, flow_id, field)
-        models.append(model_ids)
+    models = import_lib.read_models_cache(cache_file_name, models_hash)
+    if models is not None:
+        return models
 
+    models_catalog = json.loads(models_content)
+    models = motlin_async_lib.run(import_lib.sync_models(access_token, models_catalog))
+    for model, model_ids in zip(models_catalog, models):
+        if not model_ids['flow_id']:
+            continue
+        item_index.add_items('flows', [{'id': model_ids['flow_id'], 'name': model['flow']['name'], 'slug': model['flow']['slug']}])
+        item_index.add_items(
+            index_lib.get_collection_name('fields', model['flow']['slug']),
+            [{'id': model_ids['fields'][field['name']], 'slug': field['slug']} for field in model['fields']]
+        )
+    if all(model_ids['flow_id'] for model_ids in models):
+        import_lib.save_models_cache(cache_file_name, models_hash, models)
     return models
 
 
-def load_image(access_token, product_id, image_folder, image_url):
-    url_path = urlparse(image_url).path
-    image_file = url_path.split('/')[-1]
-
-    response = requests.get(image_url)
-    response.raise_for_status()
-
-    image_path = os.path.join(image_folder, image_file)
-    with open(image_path, 'wb') as file_handler:
-        file_handler.write(response.content)
-    load_file(access_token, product_id, image_path)
+def load_products_from_file(access_token, filename, image_manifest, import_manifest,
+                            workers=import_lib.IMPORT_WORKERS, rps=import_lib.IMPORT_RPS,
+                            dry_run=False, delete=False):
 
+    with open(filename, 'r') as file_handler:
+        products = {str(product['id']): product for product in json.load(file_handler)}
 
-def load_products_from_file(access_token, filename, image_folder):
+    stats = import_lib.ImportStats()
+    catalog = motlin_async_lib.run(import_lib.get_products_catalog(access_token, stats))
+    import_plan = import_lib.make_import_plan(
+        products, catalog, import_manifest.get_section('products'), delete
+    )
+    if dry_run:
+        return import_plan, stats
 
-    with open(filename, 'r') as file_handler:
-        products = json.load(file_handler)
-
-    for product in tqdm(products, desc="Загружено", unit="наименований"):
-        product_characteristic = {
-            'type': 'product',
-            'name': product['name'],
-            'slug': slugify(product['name']),
-            'sku': str(product['id']),
-            'description': product['description'],
-            'manage_stock': False,
-            'price': [
-                {
-                    'amount': product['price'],
-                    'currency': 'RUB',
-                    'includes_tax': True
-                }
-            ],
-            'status': 'live',
-            'commodity_type': 'physical'
-        }
-        product_id = get_item_id(
-            access_token, 'products',
-            field='sku', value=str(product['id'])
+    with tqdm(total=import_lib.get_changes_count(import_plan), desc="Загружено", unit="наименований") as progress:
+        motlin_async_lib.run(
+            import_lib.import_products(
+                access_token,
+                [products[sku] for sku in import_plan['create'] + import_plan['update']],
+                import_plan['delete'], catalog, image_manifest, import_manifest,
+                stats, workers, rps, progress
+            )
         )
-        if product_id:
-            update_product(access_token, product_id, product_characteristic)
-        else:
-            product_id = add_new_product(access_token, product_characteristic)
-        if product['product_image']['url']:
-            load_image(access_token, product_id, image_folder, product['product_image']['url'])
+    item_index.add_items('products', [{'id': item_id, 'sku': sku} for sku, (item_id, _) in catalog.items()], ['sku'])
+    for sku in import_plan['delete']:
+        item_index.remove('products', 'sku', sku)
+    return import_plan, stats
 
 
-def load_addresses_from_file(access_token, filename, pizzeria_model):
+def load_addresses_from_file(access_token, filename, pizzeria_model, import_manifest,
+                             workers=import_lib.IMPORT_WORKERS, rps=import_lib.IMPORT_RPS,
+                             dry_run=False, delete=False):
 
     with open(filename, 'r') as file_handler:
-        addresses = json.load(file_handler)
-
-    for address in tqdm(addresses, desc="Загружено", unit="адресов"):
-        save_address(
-            access_token,
-            pizzeria_model['flow_slug'],
-            'address',
-            address['address']['full'],
-            address={
+        addresses = {
+            address['address']['full']: {
                 'address': address['address']['full'],
                 'alias': address['alias'],
                 'longitude': address['coordinates']['lon'],
                 'latitude': address['coordinates']['lat']
             }
-        )
+            for address in json.load(file_handler)
+        }
+
+    slug = pizzeria_model['flow_slug']
+    stats = import_lib.ImportStats()
+    entry_ids = motlin_async_lib.run(import_lib.get_entry_ids(access_token, slug, 'address', stats))
+    import_plan = import_lib.make_import_plan(addresses, entry_ids, import_manifest.get_section(slug), delete)
+    if dry_run:
+        return import_plan, stats
+
+    changed_addresses = import_plan['create'] + import_plan['update']
+    save_addresses(
+        access_token, slug, 'address',
+        [addresses[address] for address in changed_addresses],
+        import_plan['delete'], entry_ids, stats, workers, rps
+    )
+    for address in changed_addresses:
+        import_manifest.set(slug, address, import_lib.get_fingerprint(addresses[address]))
+    for address in import_plan['delete']:
+        import_manifest.remove(slug, address)
+    return import_plan, stats
+
+
+def save_addresses(access_token, slug, field, addresses, deleted_values=(), entry_ids=None, stats=None,
+                   workers=import_lib.IMPORT_WORKERS, rps=import_lib.IMPORT_RPS):
+    stats = stats or import_lib.ImportStats()
+    if entry_ids is None:
+        entry_ids = motlin_async_lib.run(import_lib.get_entry_ids(access_token, slug, field, stats))
+    collection = index_lib.get_collection_name('entries', slug)
+    with tqdm(total=len(addresses) + len(deleted_values), desc="Загружено", unit="адресов") as progress:
+        try:
+            motlin_async_lib.run(
+                import_lib.upsert_entries(
+                    access_token, slug, field, addresses, deleted_values,
+                    entry_ids, stats, workers, rps, progress
+                )
+            )
+        finally:
+            item_index.add_items(collection, [{'id': entry_id, field: value} for value, entry_id in entry_ids.items()], [field])
+            for value in deleted_values:
+                if str(value) not in entry_ids:
+                    item_index.remove(collection, field, value)
+            if slug == CUSTOMER_ADDRESS_SLUG:
+                for address in addresses:
+                    invalidate_customer_profile(address['customerid'])
+                for value in deleted_values:
+                    invalidate_customer_profile(value)
+    return entry_ids
+
+
+def update_existing_entry(access_token, flow_slug, entry_id, fields):
+    try:
+        return update_entry(access_token, flow_slug, entry_id, fields)
+    except requests.exceptions.HTTPError as error:
+        if not is_not_found(error):
+            raise
+        return None
 
 
 def save_address(access_token, slug, field, value, address):
     entry_id = get_item_id(access_token, 'entries', slug=slug, field=field, value=value)
-    if entry_id:
-        update_entry(access_token, slug, entry_id, address)
-    else:
-        add_new_entry(access_token, slug, address)
+    entry = update_existing_entry(access_token, slug, entry_id, address) if entry_id else None
+    if entry_id and not entry:
+        drop_item_id('entries', slug=slug, field=field, value=value)
+        entry_id = get_item_id(access_token, 'entries', slug=slug, field=field, value=value)
+        entry = update_existing_entry(access_token, slug, entry_id, address) if entry_id else None
+    if not entry:
+        entry_id = add_new_entry(access_token, slug, address)
+        entry = dict(address, id=entry_id)
+    item_index.add(index_lib.get_collection_name('entries', slug), field, value, entry_id)
+    return entry
 
 
-def create_order(access_token, chat_id):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    customer_address = get_address(access_token, 'customeraddress', 'customerid', str(chat_id))
-    customer_id = get_customer(access_token, 'email', customer_address['email'])
-    customer_info = execute_get_request(
-        f'https://api.moltin.com/v2/customers/{customer_id}',
-        {'Authorization': access_token}
+def get_customer_profile(access_token, chat_id):
+    customer_profile = profile_cache.get(chat_id)
+    if customer_profile:
+        return customer_profile
+    customer_profile = get_address(access_token, CUSTOMER_ADDRESS_SLUG, 'customerid', str(chat_id))
+    return profile_cache.set(chat_id, get_full_profile(customer_profile) if customer_profile else None)
+
+
+def get_full_profile(customer_profile):
+    return dict(dict.fromkeys(CUSTOMER_ADDRESS_FIELDS), **customer_profile)
+
+
+def save_customer_profile(access_token, chat_id, fields):
+    customer_profile = profile_cache.get(chat_id)
+    address = dict(fields, customerid=str(chat_id))
+    entry = None
+    if customer_profile and customer_profile.get('id'):
+        entry = update_existing_entry(access_token, CUSTOMER_ADDRESS_SLUG, customer_profile['id'], address)
+    if not entry:
+        entry = save_address(access_token, CUSTOMER_ADDRESS_SLUG, 'customerid', str(chat_id), address)
+    return profile_cache.set(chat_id, get_full_profile(entry))
+
+
+def invalidate_customer_profile(chat_id):
+    profile_cache.delete(chat_id)
+
+
+def create_order(access_token, chat_id, checkout_key=None):
+    customer_address = get_customer_profile(access_token, chat_id)
+    customer_info = get_indexed_item(
+        access_token, get_customer_info, 'customers', field='email', value=customer_address['email']
     )
-    data = {
-        'data': {
-            'customer': {
-                'id': customer_id
-            },
-            'billing_address': {
-                'first_name': customer_info['name'],
-                'last_name': customer_info['name'],
-                'line_1': customer_address['address'],
-                'city': customer_address['city'],
-                'postcode': '0000',
-                'county': customer_address['county'],
-                'country': customer_address['country']
-            },
-            'shipping_address': {
-                'first_name': customer_info['name'],
-                'last_name': customer_info['name'],
-                'phone_number': customer_address['telephone'],
-                'line_1': customer_address['address'],
-                'postcode': '0000',
-                'county': customer_address['county'],
-                'country': customer_address['country']
-            }
-        }
-    }
-    response = requests.post(
-        f'https://api.moltin.com/v2/carts/{chat_id}/checkout',
-        headers=headers,
-        json=data
+    if not customer_info:
+        customer_info = get_customer_info(access_token, add_new_customer(access_token, customer_address['email']))
+    return motlin_async_lib.run(
+        motlin_async_lib.checkout(access_token, chat_id, customer_address, customer_info, checkout_key)
     )
-    response.raise_for_status()
-    return response.json()['data']['id']
+
+
+def find_order(access_token, chat_id, checkout_key):
+    customer_address = get_customer_profile(access_token, chat_id)
+    customer_id = get_customer(access_token, 'email', customer_address['email'])
+    return motlin_async_lib.run(motlin_async_lib.find_order(access_token, customer_id, checkout_key))
 
 
 def set_order_payment(access_token, order_id):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'gateway': 'manual',
-            'method': 'authorize'
-        }
-    }
-    response = requests.post(
-        f'https://api.moltin.com/v2/orders/{order_id}/payments',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
-    return response.json()['data']['id']
+    return motlin_async_lib.run(motlin_async_lib.set_order_payment(access_token, order_id))
 
 
 def confirm_order_payment(access_token, order_id, transaction_id):
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'gateway': 'manual',
-            'method': 'capture'
-        }
-    }
-    response = requests.post(
-        f'https://api.moltin.com/v2/orders/{order_id}/transactions/{transaction_id}/capture',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
+    return motlin_async_lib.run(motlin_async_lib.confirm_order_payment(access_token, order_id, transaction_id))
 
 
 def confirm_order_shipping(access_token, order_id):
-    if not order_id:
-        return
-    headers = {'Authorization': access_token, 'Content-Type': 'application/json'}
-    data = {
-        'data': {
-            'type': 'order',
-            'shipping': 'fulfilled'
-        }
-    }
-    response = requests.put(
-        f'https://api.moltin.com/v2/orders/{order_id}',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
+    return motlin_async_lib.run(motlin_async_lib.confirm_order_shipping(access_token, order_id))
@@ -0,0 +1,44 @@
+import json
+
+from libs import motlin_lib
+
+PROFILE_UPDATES_KEY = 'profile:updates'
+PROFILE_FLUSH_DELAY = 30
+
+
+class ProfileBuffer(object):
+
+    def __init__(self, redis_conn, scheduler, flush_delay=PROFILE_FLUSH_DELAY):
+        self.redis_conn = redis_conn
+        self.scheduler = scheduler
+        self.flush_delay = flush_delay
+
+    def get_updates(self, chat_id):
+        return {
+            field: json.loads(value)
+            for field, value in self.redis_conn.get_all(f'{PROFILE_UPDATES_KEY}:{chat_id}').items()
+        }
+
+    def save(self, access_token, chat_id, fields):
+        customer_profile = motlin_lib.get_customer_profile(access_token, chat_id) or {}
+        motlin_lib.profile_cache.set(chat_id, motlin_lib.get_full_profile(dict(customer_profile, **fields)))
+        self.redis_conn.add_values(
+            f'{PROFILE_UPDATES_KEY}:{chat_id}',
+            {field: json.dumps(value) for field, value in fields.items()}
+        )
+        self.scheduler.schedule(f'profile:{chat_id}', 'flush_profile', self.flush_delay, context=chat_id)
+
+    def flush(self, access_token, chat_id):
+        updates = self.get_updates(chat_id)
+        if not updates:
+            return
+        customer_profile = motlin_lib.save_customer_profile(access_token, chat_id, updates)
+        pending_updates = {}
+        with self.redis_conn.pipeline() as pipeline:
+            for field, value in self.get_updates(chat_id).items():
+                if updates.get(field) == value:
+                    pipeline.del_key(f'{PROFILE_UPDATES_KEY}:{chat_id}', field)
+                else:
+                    pending_updates[field] = value
+        if pending_updates:
+            motlin_lib.profile_cache.set(chat_id, dict(customer_profile, **pending_updates))
@@ -1,4 +1,108 @@
 import redis
+from contextlib import contextmanager
+
+
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+TRANSITION_ATTEMPTS = 3
+
+
+class TransitionConflict(Exception):
+    pass
+
+
+def decode(value):
+    return value.decode("utf-8") if value else None
+
+
+class RedisPipeline(object):
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def add_value(self, name, key, value):
+        self.pipeline.hset(name, mapping={key: value})
+
+    def add_values(self, name, mapping):
+        if mapping:
+            self.pipeline.hset(name, mapping=mapping)
+
+    def del_value(self, name):
+        self.pipeline.delete(name)
+
+    def del_key(self, name, key):
+        self.pipeline.hdel(name, key)
+
+    def set_expire(self, name, seconds):
+        self.pipeline.expire(name, seconds)
+
+    def increment_value(self, name, key, amount=1):
+        self.pipeline.hincrby(name, key, amount)
+
+    def add_to_schedule(self, name, key, score):
+        self.pipeline.zadd(name, {key: score})
+
+    def del_from_schedule(self, name, *keys):
+        if keys:
+            self.pipeline.zrem(name, *keys)
+
+    def add_member(self, name, member):
+        self.pipeline.sadd(name, member)
+
+    def del_member(self, name, member):
+        self.pipeline.srem(name, member)
+
+    def execute(self):
+        return self.pipeline.execute()
+
+
+class RedisSession(object):
+
+    def __init__(self, redis_db, name, pipeline):
+        self.redis_db = redis_db
+        self.name = str(name)
+        self.pipeline = pipeline
+        self.values = redis_db.get_all(name)
+        self.snapshot = dict(self.values)
+        self.writes = []
+        self.conflicts = set()
+
+    def get_value(self, name, key):
+        if str(name) != self.name:
+            return self.redis_db.get_value(name, key)
+        return self.values.get(key)
+
+    def get_values(self, name, *keys):
+        if str(name) != self.name:
+            return self.redis_db.get_values(name, *keys)
+        return [self.values.get(key) for key in keys]
+
+    def add_value(self, name, key, value):
+        self.add_values(name, {key: value})
+
+    def add_values(self, name, mapping):
+        if str(name) == self.name:
+            self.values.update({key: str(value) for key, value in mapping.items()})
+        self.pipeline.add_values(name, mapping)
+        self.writes.append(('add_values', str(name), mapping))
+
+    def del_value(self, name):
+        if str(name) == self.name:
+            self.values.clear()
+        self.pipeline.del_value(name)
+        self.writes.append(('del_value', str(name)))
+
+    def del_key(self, name, key):
+        if str(name) == self.name:
+            self.values.pop(key, None)
+        self.pipeline.del_key(name, key)
+        self.writes.append(('del_key', str(name), key))
 
 
 class RedisDb(object):
@@ -9,6 +113,7 @@ class RedisDb(object):
             port=port,
             db=0, password=password
         )
+        self.renew_lease_script = self.redis_conn.register_script(RENEW_LEASE_SCRIPT)
 
     def clear_db(self):
         self.redis_conn.flushdb()
@@ -18,7 +123,117 @@ class RedisDb(object):
 
     def get_value(self, name, key):
         value = self.redis_conn.hmget(name, (key))[0]
-        return value.decode("utf-8") if value else None
+        return decode(value)
+
+    def get_values(self, name, *keys):
+        return [decode(value) for value in self.redis_conn.hmget(name, keys)]
+
+    def get_string(self, name):
+        return decode(self.redis_conn.get(name))
+
+    def set_string(self, name, value, seconds):
+        self.redis_conn.setex(name, seconds, value)
+
+    def get_all(self, name):
+        return {decode(key): decode(value) for key, value in self.redis_conn.hgetall(name).items()}
 
     def del_value(self, name):
         self.redis_conn.delete(name)
+
+    def increment_value(self, name, key, amount=1):
+        return self.redis_conn.hincrby(name, key, amount)
+
+    def set_expire(self, name, seconds):
+        self.redis_conn.expire(name, seconds)
+
+    def add_values(self, name, mapping):
+        if mapping:
+            self.redis_conn.hset(name, mapping=mapping)
+
+    def del_key(self, name, key):
+        self.redis_conn.hdel(name, key)
+
+    def get_due(self, name, max_score, limit):
+        return [decode(key) for key in self.redis_conn.zrangebyscore(name, '-inf', max_score, start=0, num=limit)]
+
+    def claim_from_schedule(self, name, key):
+        return bool(self.redis_conn.zrem(name, key))
+
+    def get_members(self, name):
+        return {decode(member) for member in self.redis_conn.smembers(name)}
+
+    def push_value(self, name, value):
+        self.redis_conn.lpush(name, value)
+
+    def pop_value(self, name, timeout):
+        value = self.redis_conn.brpop(name, timeout=timeout)
+        return decode(value[1]) if value else None
+
+    def acquire_lease(self, name, owner, ttl):
+        return bool(self.redis_conn.set(name, owner, px=int(ttl * 1000), nx=True))
+
+    def renew_lease(self, name, owner, ttl):
+        return bool(self.renew_lease_script(keys=[name], args=[owner, int(ttl * 1000)]))
+
+    def get_lock(self, name, timeout):
+        return self.redis_conn.lock(name, timeout=timeout, thread_local=False)
+
+    @contextmanager
+    def pipeline(self, transaction=True, execute_on_error=False):
+        redis_pipeline = self.redis_conn.pipeline(transaction=transaction)
+        try:
+            yield RedisPipeline(redis_pipeline)
+        except Exception:
+            if execute_on_error:
+                redis_pipeline.execute()
+            raise
+        else:
+            redis_pipeline.execute()
+        finally:
+            redis_pipeline.reset()
+
+    @contextmanager
+    def session(self, name):
+        with self.pipeline() as pipeline:
+            yield RedisSession(self, name, pipeline)
+
+    @contextmanager
+    def transition(self, name):
+        redis_pipeline = self.redis_conn.pipeline(transaction=True)
+        try:
+            redis_pipeline.watch(name)
+            session = RedisSession(self, name, RedisPipeline(redis_pipeline))
+            redis_pipeline.multi()
+            yield session
+            redis_pipeline.execute()
+        except redis.WatchError:
+            session.conflicts = self.merge_writes(session.name, session.snapshot, session.writes)
+        finally:
+            redis_pipeline.reset()
+
+    def merge_writes(self, name, snapshot, writes):
+        for _ in range(TRANSITION_ATTEMPTS):
+            redis_pipeline = self.redis_conn.pipeline(transaction=True)
+            try:
+                redis_pipeline.watch(name)
+                values = self.get_all(name)
+                conflicts = {key for key in set(snapshot) | set(values) if snapshot.get(key) != values.get(key)}
+                redis_pipeline.multi()
+                pipeline = RedisPipeline(redis_pipeline)
+                for method, write_name, *args in writes:
+                    if write_name != name:
+                        getattr(pipeline, method)(write_name, *args)
+                    elif method == 'add_values':
+                        pipeline.add_values(name, {key: value for key, value in args[0].items() if key not in conflicts})
+                    elif method == 'del_key' and args[0] not in conflicts:
+                        pipeline.del_key(name, args[0])
+                    elif method == 'del_value':
+                        pipeline.del_value(name)
+                        pipeline.add_values(name, {key: values[key] for key in conflicts if key in values})
+                redis_pipeline.execute()
+                return conflicts
+            except redis.WatchError:
+                continue
+            finally:
+                redis_pipeline.reset()
+        raise TransitionConflict(name)
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+import zlib
+
+LEASE_KEY = 'leader'
+LEASE_TTL = 15
+UPDATES_KEY = 'updates'
+POP_TIMEOUT = 5
+
+logger = logging.getLogger('pizza_delivery_bot')
+
+
+def get_replica_index(chat_id, replicas):
+    return zlib.crc32(str(chat_id).encode('utf-8')) % replicas
+
+
+def get_local_replica_index(replicas, dyno=None, replica_index=None):
+    if dyno:
+        replica_index = int(dyno.split('.')[-1]) - 1
+    replica_index = int(replica_index or 0)
+    if not 0 <= replica_index < replicas:
+        raise ValueError(f'Номер экземпляра {replica_index} вне диапазона от 0 до {replicas - 1}')
+    return replica_index
+
+
+class LeaderLease(object):
+
+    def __init__(self, redis_conn, owner, ttl=LEASE_TTL):
+        self.redis_conn = redis_conn
+        self.owner = owner
+        self.ttl = ttl
+        self.leader = False
+
+    def is_leader(self):
+        return self.leader
+
+    def hold(self):
+        while True:
+            try:
+                if self.leader:
+                    self.leader = self.redis_conn.renew_lease(LEASE_KEY, self.owner, self.ttl)
+                else:
+                    self.leader = self.redis_conn.acquire_lease(LEASE_KEY, self.owner, self.ttl)
+            except Exception as error:
+                self.leader = False
+                logger.exception(f'Ошибка продления лидерства: {error}')
+            time.sleep(self.ttl / 3)
+
+    def start(self):
+        threading.Thread(target=self.hold, daemon=True).start()
+
+
+class UpdateRouter(object):
+
+    def __init__(self, redis_conn, replica_index, replicas):
+        self.redis_conn = redis_conn
+        self.replica_index = replica_index
+        self.replicas = replicas
+
+    def is_local(self, chat_id):
+        return get_replica_index(chat_id, self.replicas) == self.replica_index
+
+    def forward(self, chat_id, update_json):
+        replica_index = get_replica_index(chat_id, self.replicas)
+        self.redis_conn.push_value(f'{UPDATES_KEY}:{replica_index}', update_json)
+
+    def consume(self, handle_update):
+        while True:
+            try:
+                update_json = self.redis_conn.pop_value(f'{UPDATES_KEY}:{self.replica_index}', POP_TIMEOUT)
+                if update_json:
+                    handle_update(update_json)
+            except Exception as error:
+                logger.exception(f'Ошибка получения обновлений реплики: {error}')
+                time.sleep(POP_TIMEOUT)
+
+    def start(self, handle_update):
+        threading.Thread(target=self.consume, args=(handle_update,), daemon=True).start()
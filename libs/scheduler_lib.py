@@ -0,0 +1,77 @@
+import json
+import logging
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+JOBS_KEY = 'jobs'
+JOB_PAYLOADS_KEY = 'jobs:payloads'
+CHAT_JOBS_KEY = 'jobs:chat'
+POLL_INTERVAL = 1
+BATCH_SIZE = 100
+SCHEDULER_WORKERS = 8
+
+logger = logging.getLogger('pizza_delivery_bot')
+
+ScheduledJob = namedtuple('ScheduledJob', ['key', 'context'])
+
+
+def get_chat_jobs_key(chat_id):
+    return f'{CHAT_JOBS_KEY}:{chat_id}'
+
+
+class JobScheduler(object):
+
+    def __init__(self, redis_conn, callbacks, workers=SCHEDULER_WORKERS):
+        self.redis_conn = redis_conn
+        self.callbacks = callbacks
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def schedule(self, key, callback, delay, context=None, chat_id=None):
+        payload = json.dumps({'callback': callback, 'context': context, 'chat_id': chat_id})
+        with self.redis_conn.pipeline() as pipeline:
+            pipeline.add_value(JOB_PAYLOADS_KEY, key, payload)
+            pipeline.add_to_schedule(JOBS_KEY, key, time.time() + delay)
+            if chat_id is not None:
+                pipeline.add_member(get_chat_jobs_key(chat_id), key)
+
+    def remove(self, key):
+        payload = json.loads(self.redis_conn.get_value(JOB_PAYLOADS_KEY, key) or '{}')
+        with self.redis_conn.pipeline() as pipeline:
+            pipeline.del_from_schedule(JOBS_KEY, key)
+            pipeline.del_key(JOB_PAYLOADS_KEY, key)
+            if payload.get('chat_id') is not None:
+                pipeline.del_member(get_chat_jobs_key(payload['chat_id']), key)
+
+    def remove_chat_jobs(self, chat_id):
+        keys = self.redis_conn.get_members(get_chat_jobs_key(chat_id))
+        with self.redis_conn.pipeline() as pipeline:
+            pipeline.del_from_schedule(JOBS_KEY, *keys)
+            for key in keys:
+                pipeline.del_key(JOB_PAYLOADS_KEY, key)
+            pipeline.del_value(get_chat_jobs_key(chat_id))
+
+    def claim_due_jobs(self):
+        for key in self.redis_conn.get_due(JOBS_KEY, time.time(), BATCH_SIZE):
+            if not self.redis_conn.claim_from_schedule(JOBS_KEY, key):
+                continue
+            payload = self.redis_conn.get_value(JOB_PAYLOADS_KEY, key)
+            if not payload:
+                continue
+            payload = json.loads(payload)
+            with self.redis_conn.pipeline() as pipeline:
+                pipeline.del_key(JOB_PAYLOADS_KEY, key)
+                if payload['chat_id'] is not None:
+                    pipeline.del_member(get_chat_jobs_key(payload['chat_id']), key)
+            yield key, payload
+
+    def run_job(self, bot, key, payload):
+        try:
+            self.callbacks[payload['callback']](bot, ScheduledJob(key, payload['context']))
+        except Exception as error:
+            logger.exception(f'Ошибка задачи {key}: {error}')
+
+    def run_pending(self, bot, job):
+        for key, payload in self.claim_due_jobs():
+            self.executor.submit(self.run_job, bot, key, payload)
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from redis.exceptions import LockError
+
+from libs import motlin_lib
+
+TOKEN_KEY = 'motlin_token'
+TOKEN_LOCK_KEY = 'motlin_token:lock'
+REFRESH_MARGIN = 300
+LOCK_TIMEOUT = 30
+WAIT_PERIOD = 0.2
+
+logger = logging.getLogger('pizza_delivery_bot')
+
+
+class MotlinTokenManager(object):
+
+    def __init__(self, redis_conn, client_secret, client_id, refresh_margin=REFRESH_MARGIN):
+        self.redis_conn = redis_conn
+        self.client_secret = client_secret
+        self.client_id = client_id
+        self.refresh_margin = refresh_margin
+        self.token, self.expires = None, 0
+        self.refresh_lock = threading.Lock()
+
+    def is_fresh(self):
+        return self.token and self.expires - self.refresh_margin > time.time()
+
+    def get_token(self):
+        if not self.is_fresh():
+            self.load_token()
+        if not self.is_fresh():
+            with self.refresh_lock:
+                self.refresh_token()
+        return self.token
+
+    def load_token(self):
+        token = self.redis_conn.get_value(TOKEN_KEY, 'token')
+        expires = self.redis_conn.get_value(TOKEN_KEY, 'expires')
+        if token and expires and float(expires) > self.expires:
+            self.token, self.expires = token, float(expires)
+
+    def refresh_token(self):
+        lock = self.redis_conn.get_lock(TOKEN_LOCK_KEY, LOCK_TIMEOUT)
+        wait_until = time.time() + LOCK_TIMEOUT
+        while not self.is_fresh():
+            if lock.acquire(blocking=False):
+                try:
+                    self.load_token()
+                    if not self.is_fresh():
+                        self.token, self.expires = motlin_lib.get_moltin_access_token(
+                            client_secret=self.client_secret,
+                            client_id=self.client_id
+                        )
+                        self.redis_conn.add_values(TOKEN_KEY, {'token': self.token, 'expires': self.expires})
+                finally:
+                    try:
+                        lock.release()
+                    except LockError as error:
+                        logger.warning(f'Блокировка обновления токена Moltin истекла: {error}')
+            elif time.time() > wait_until:
+                raise TimeoutError('Не дождались обновления токена Moltin')
+            else:
+                time.sleep(WAIT_PERIOD)
+                self.load_token()
+
+    def refresh_periodically(self):
+        while True:
+            try:
+                self.get_token()
+            except Exception:
+                time.sleep(WAIT_PERIOD * 50)
+                continue
+            time.sleep(max(self.expires - self.refresh_margin - time.time(), WAIT_PERIOD))
+
+    def start(self):
+        self.get_token()
+        threading.Thread(target=self.refresh_periodically, daemon=True).start()
@@ -1,38 +1,78 @@
 import os
 import argparse
+import json
 import requests
+from libs import import_lib
 from libs import motlin_lib
+from libs import redis_lib
+from libs import token_lib
 from dotenv import load_dotenv
 
-TEMPORARY_IMAGE_FOLDER = 'images'
+IMAGE_MANIFEST = 'images.json'
+IMPORT_MANIFEST = 'import.json'
+MODELS_CACHE = 'models_cache.json'
 
 
 def create_parser():
     parser = argparse.ArgumentParser(description='Параметры запуска скрипта')
     parser.add_argument('-m', '--models', default='models.json', help='Путь к *.json файлу с описанием моделей')
+    parser.add_argument('-c', '--models-cache', default=MODELS_CACHE, help='Путь к *.json файлу с идентификаторами моделей в Moltin')
     parser.add_argument('-p', '--products', default='', help='Путь к *.json файлу с продуктами который необходимо загрузить')
     parser.add_argument('-a', '--address', default='', help='Путь к *.json файлу с адресами который необходимо загрузить')
+    parser.add_argument('-i', '--images', default=IMAGE_MANIFEST, help='Путь к *.json файлу с описанием загруженных изображений')
+    parser.add_argument('-s', '--manifest', default=IMPORT_MANIFEST, help='Путь к *.json файлу с отпечатками загруженных записей')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Только показать план изменений')
+    parser.add_argument('-d', '--delete', action='store_true', help='Удалить записи, отсутствующие в файлах')
+    parser.add_argument('-w', '--workers', default=import_lib.IMPORT_WORKERS, type=int, help='Количество параллельных загрузок')
+    parser.add_argument('-r', '--rps', default=import_lib.IMPORT_RPS, type=float, help='Ограничение запросов к Moltin в секунду')
     return parser
 
 
 def main():
     load_dotenv()
-    motlin_token, token_expires = motlin_lib.get_moltin_access_token(
+    redis_conn = redis_lib.RedisDb(
+        os.getenv('REDIS_HOST'),
+        os.getenv('REDIS_PORT'),
+        os.getenv('REDIS_PASSWORD')
+    )
+    motlin_lib.initialize_cache(redis_conn)
+    motlin_token = token_lib.MotlinTokenManager(
+        redis_conn,
         client_secret=os.getenv('MOLTIN_CLIENT_SECRET'),
         client_id=os.getenv('MOLTIN_CLIENT_ID')
-    )
+    ).get_token()
 
     parser = create_parser()
     args = parser.parse_args()
-    os.makedirs(TEMPORARY_IMAGE_FOLDER, exist_ok=True)
 
+    image_manifest = import_lib.ImageManifest(args.images)
+    import_manifest = import_lib.ImportManifest(args.manifest)
     try:
-        models = motlin_lib.read_models_from_file(motlin_token, args.models)
+        if args.dry_run:
+            with open(args.models, 'r') as file_handler:
+                models = [{'flow_slug': model['flow']['slug']} for model in json.load(file_handler)]
+        else:
+            models = motlin_lib.read_models_from_file(motlin_token, args.models, args.models_cache)
         if args.products:
-            motlin_lib.load_products_from_file(motlin_token, args.products, TEMPORARY_IMAGE_FOLDER)
+            import_plan, import_stats = motlin_lib.load_products_from_file(
+                motlin_token, args.products, image_manifest, import_manifest,
+                workers=args.workers, rps=args.rps,
+                dry_run=args.dry_run, delete=args.delete
+            )
+            print(import_lib.format_import_plan('Продукты', import_plan))
+            if not args.dry_run:
+                motlin_lib.catalog_cache.invalidate()
+                print(import_stats.get_report())
         if args.address:
             pizzeria_model = [model for model in models if model['flow_slug'] == 'pizzeria'][0]
-            motlin_lib.load_addresses_from_file(motlin_token, args.address, pizzeria_model)
+            import_plan, import_stats = motlin_lib.load_addresses_from_file(
+                motlin_token, args.address, pizzeria_model, import_manifest,
+                workers=args.workers, rps=args.rps,
+                dry_run=args.dry_run, delete=args.delete
+            )
+            print(import_lib.format_import_plan('Адреса', import_plan))
+            if not args.dry_run:
+                print(import_stats.get_report())
     except OSError as error:
         print(f'Ошибка загрузки файла: {error}')
     except (KeyError, TypeError, ValueError) as error:
@@ -42,12 +82,9 @@ def main():
     except requests.exceptions.HTTPError:
         print('Ошибка записи данных на сайт Motlin')
     finally:
-        for root, dirs, files in os.walk(TEMPORARY_IMAGE_FOLDER, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(TEMPORARY_IMAGE_FOLDER)
+        if not args.dry_run:
+            image_manifest.save()
+            import_manifest.save()
 
 
 if __name__ == "__main__":
@@ -1,25 +1,35 @@
+import json
 import logging
 import phonenumbers
 import os
-from datetime import datetime
+import socket
+import threading
 from dotenv import load_dotenv
 
+from libs import checkout_lib
+from libs import dispatch_lib
 from libs import geo_lib
 from libs import logger_lib
+from libs import motlin_async_lib
 from libs import motlin_lib
+from libs import profile_lib
 from libs import redis_lib
+from libs import replica_lib
+from libs import scheduler_lib
+from libs import token_lib
 
-from telegram import LabeledPrice
-from telegram.ext import Filters, Updater
+from telegram import LabeledPrice, Update
+from telegram.ext import DispatcherHandlerStop, Filters, TypeHandler, Updater
 from telegram.ext import PreCheckoutQueryHandler
 from telegram.ext import CallbackQueryHandler, MessageHandler, CommandHandler
 from tg_bot_events import add_product_to_cart, choose_payment_type
 from tg_bot_events import clear_settings_and_task_queue, get_delivery_time
 from tg_bot_events import delete_messages, choose_deliviry, confirm_deliviry
-from tg_bot_events import confirm_order, find_nearest_address, send_courier_message
+from tg_bot_events import confirm_order, find_nearest_address, resend_courier_message
 from tg_bot_events import save_customer_phone, save_customer_email, save_customer_address
 from tg_bot_events import show_store_menu, show_product_card, show_products_in_cart
-from tg_bot_events import show_reminder, show_customers_menu, send_or_update_courier_messages
+from tg_bot_events import show_reminder, show_customers_menu, update_courier_messages
+from tg_bot_events import update_pizzeria_index, register_courier_delivery, notify_order_confirmed
 
 from validate_email import validate_email
 
@@ -27,6 +37,7 @@ logger = logging.getLogger('pizza_delivery_bot')
 
 CLIENT_REMINDER_PERIOD = 3600
 COURIER_REMINDER_PERIOD = 60
+PIZZERIA_INDEX_REFRESH_PERIOD = 300
 PORT = os.getenv('PORT')
 
 
@@ -36,6 +47,9 @@ class TgDialogBot(object):
         self.tg_token = tg_token
         self.params = params
         self.updater = Updater(token=tg_token)
+        self.router = replica_lib.UpdateRouter(params['redis_conn'], params['replica_index'], params['replicas'])
+        if params['replicas'] > 1:
+            self.updater.dispatcher.add_handler(TypeHandler(Update, self.route_update), group=-1)
         self.updater.dispatcher.add_handler(CallbackQueryHandler(self.handle_users_reply))
         self.updater.dispatcher.add_handler(MessageHandler(Filters.successful_payment, self.handle_users_reply))
         self.updater.dispatcher.add_handler(MessageHandler(Filters.text, self.handle_users_reply))
@@ -44,27 +58,101 @@ class TgDialogBot(object):
         self.updater.dispatcher.add_handler(PreCheckoutQueryHandler(self.handle_users_reply))
         self.updater.dispatcher.add_error_handler(self.error)
         self.states_functions = states_functions
-        self.motlin_token, self.token_expires = None, 0
-        self.params['job'] = self.updater.job_queue
+        self.token_manager = token_lib.MotlinTokenManager(
+            params['redis_conn'],
+            client_secret=params['motlin_client_secret'],
+            client_id=params['motlin_client_id']
+        )
+        self.courier_messages_lock = threading.Lock()
+        self.lease = replica_lib.LeaderLease(params['redis_conn'], f'{socket.gethostname()}:{os.getpid()}')
+        self.chat_dispatcher = dispatch_lib.ChatDispatcher(
+            motlin_async_lib.get_event_loop(),
+            self.run_state_handler,
+            params['dispatch_workers']
+        )
+        self.params['scheduler'] = scheduler_lib.JobScheduler(
+            params['redis_conn'],
+            {
+                'show_reminder': show_reminder,
+                'update_courier_messages': self.refresh_courier_messages,
+                'process_checkout': self.process_checkout,
+                'flush_profile': self.flush_profile
+            }
+        )
+        self.params['profiles'] = profile_lib.ProfileBuffer(params['redis_conn'], self.params['scheduler'])
+        self.params['checkout'] = checkout_lib.CheckoutPipeline(
+            params['redis_conn'], self.params['scheduler'], self.params['profiles']
+        )
 
     def start(self):
+        self.token_manager.start()
+        self.lease.start()
+        if self.params['replicas'] > 1:
+            self.router.start(self.put_update)
+        self.updater.job_queue.run_repeating(
+            self.run_if_leader(self.params['scheduler'].run_pending),
+            scheduler_lib.POLL_INTERVAL,
+            first=0
+        )
+        self.updater.job_queue.run_repeating(
+            update_pizzeria_index,
+            PIZZERIA_INDEX_REFRESH_PERIOD,
+            first=0,
+            context=self.token_manager
+        )
+        self.updater.job_queue.run_repeating(
+            self.run_if_leader(self.refresh_courier_messages),
+            COURIER_REMINDER_PERIOD,
+            first=0
+        )
+        self.updater.job_queue.run_repeating(
+            self.run_if_leader(self.resume_failed_checkouts),
+            checkout_lib.FAILED_RESCAN_PERIOD,
+            first=checkout_lib.FAILED_RESCAN_PERIOD
+        )
         self.updater.start_webhook(listen="0.0.0.0", port=int(PORT), url_path=self.tg_token)
         self.updater.bot.setWebhook(self.params['heroku_url'] + self.tg_token)
         self.updater.idle()
 
+    def run_if_leader(self, callback):
+
+        def run_callback(bot, job):
+            if self.lease.is_leader():
+                callback(bot, job)
+
+        return run_callback
+
+    def refresh_courier_messages(self, bot, job):
+        with self.courier_messages_lock:
+            update_courier_messages(bot, self.params['redis_conn'])
+
+    def process_checkout(self, bot, job):
+        self.params['checkout'].process(
+            self.token_manager.get_token(), job.context,
+            lambda chat_id, order_id, failed: notify_order_confirmed(bot, chat_id, order_id, failed)
+        )
+
+    def resume_failed_checkouts(self, bot, job):
+        self.params['checkout'].resume_failed()
+
+    def flush_profile(self, bot, job):
+        self.params['profiles'].flush(self.token_manager.get_token(), job.context)
+
+    def route_update(self, bot, update):
+        chat = update.effective_chat or update.effective_user
+        if not chat or self.router.is_local(chat.id):
+            return
+        self.router.forward(chat.id, update.to_json())
+        raise DispatcherHandlerStop()
+
+    def put_update(self, update_json):
+        self.updater.dispatcher.update_queue.put(Update.de_json(json.loads(update_json), self.updater.bot))
+
     def handle_geodata(self, bot, update):
-        next_state = self.states_functions['HANDLE_WAITING'](bot, update, self.motlin_token, self.params)
-        self.params['redis_conn'].add_value(update.message.chat_id, 'state', next_state)
-
-    def update_motlin_token(self):
-        if self.token_expires < datetime.now().timestamp():
-            self.motlin_token, self.token_expires = motlin_lib.get_moltin_access_token(
-                client_secret=self.params['motlin_client_secret'],
-                client_id=self.params['motlin_client_id']
-            )
+        chat_id = update.message.chat_id
+        self.chat_dispatcher.submit(chat_id, bot, update, chat_id, 'HANDLE_WAITING')
 
     def handle_users_reply(self, bot, update):
-        self.update_motlin_token()
         if update.message:
             user_reply = update.message.text
             chat_id = update.message.chat_id
@@ -77,14 +165,21 @@ class TgDialogBot(object):
         else:
             return
 
-        if user_reply == '/start':
-            user_state = 'START'
-        else:
-            user_state = self.params['redis_conn'].get_value(chat_id, 'state')
+        self.chat_dispatcher.submit(chat_id, bot, update, chat_id, 'START' if user_reply == '/start' else None)
 
-        state_handler = self.states_functions[user_state]
-        next_state = state_handler(bot, update, self.motlin_token, self.params)
-        self.params['redis_conn'].add_value(chat_id, 'state', next_state)
+    def run_state_handler(self, bot, update, chat_id, user_state=None):
+        with self.params['redis_conn'].transition(chat_id) as session:
+            state_handler = self.states_functions[user_state or session.get_value(chat_id, 'state')]
+            next_state = state_handler(
+                bot, update, self.token_manager.get_token(),
+                dict(self.params, session=session)
+            )
+            session.add_value(chat_id, 'state', next_state)
+        if session.conflicts:
+            logger.warning(
+                f'Чат {chat_id} изменён другим чатом во время обработки, '
+                f'сохранены их значения полей: {", ".join(sorted(session.conflicts))}'
+            )
 
     def error(self, bot, update, error):
         logger.exception(f'Ошибка бота: {error}')
@@ -96,7 +191,7 @@ def start(bot, update, motlin_token, params):
         bot.send_message(chat_id=update.message.chat_id, text='Добро пожаловать! Ожидайте заказы на доставку!')
         return 'HANDLE_DELIVERY'
     else:
-        current_page = params['redis_conn'].get_value(update.message.chat_id, 'current_page')
+        current_page = params['session'].get_value(update.message.chat_id, 'current_page')
         show_store_menu(bot, update.message.chat_id, motlin_token, page=current_page)
         return 'HANDLE_MENU'
 
@@ -108,7 +203,7 @@ def handle_menu(bot, update, motlin_token, params):
         show_products_in_cart(bot, chat_id, motlin_token, query.message.message_id)
         return 'HANDLE_CART'
     elif query.data.isdecimal():
-        params['redis_conn'].add_value(chat_id, 'current_page', query.data)
+        params['session'].add_value(chat_id, 'current_page', query.data)
         show_store_menu(bot, chat_id, motlin_token, query.message.message_id, query.data)
         return 'HANDLE_MENU'
     else:
@@ -123,7 +218,7 @@ def handle_description(bot, update, motlin_token, params):
     query = update.callback_query
     chat_id = query.message.chat_id
     if query.data == 'HANDLE_MENU':
-        current_page = params['redis_conn'].get_value(chat_id, 'current_page')
+        current_page = params['session'].get_value(chat_id, 'current_page')
         show_store_menu(bot, chat_id, motlin_token, query.message.message_id, current_page)
         return query.data
     elif query.data == str(chat_id):
@@ -138,10 +233,11 @@ def handle_cart(bot, update, motlin_token, params):
     query = update.callback_query
     chat_id = query.message.chat_id
     if query.data == 'HANDLE_MENU':
-        current_page = params['redis_conn'].get_value(chat_id, 'current_page')
+        current_page = params['session'].get_value(chat_id, 'current_page')
         show_store_menu(bot, chat_id, motlin_token, query.message.message_id, current_page)
         return query.data
     elif query.data == str(chat_id):
+        motlin_lib.reconcile_cart(motlin_token, chat_id)
         show_customers_menu(bot, chat_id, motlin_token)
         delete_messages(bot, chat_id, query.message.message_id)
         return 'HANDLE_CUSTOMERS'
@@ -168,10 +264,10 @@ def handle_customers(bot, update, motlin_token, redis_conn):
         return 'HANDLE_WAITING'
 
 
-def waiting_email(bot, update, motlin_token, redis_conn):
+def waiting_email(bot, update, motlin_token, params):
     chat_id = update.message.chat_id
     if update.message.text and validate_email(update.message.text):
-        save_customer_email(bot, str(update.message.chat_id), motlin_token, update.message.text)
+        save_customer_email(bot, str(update.message.chat_id), motlin_token, update.message.text, params['profiles'])
         if not motlin_lib.get_customer(motlin_token, 'email', update.message.text):
             motlin_lib.add_new_customer(motlin_token, update.message.text)
         show_customers_menu(bot, chat_id, motlin_token)
@@ -185,7 +281,7 @@ def waiting_email(bot, update, motlin_token, redis_conn):
 def waiting_phone(bot, update, motlin_token, params):
     chat_id = update.message.chat_id
     if update.message.text and phonenumbers.is_valid_number(phonenumbers.parse(update.message.text, 'RU')):
-        save_customer_phone(bot, str(update.message.chat_id), motlin_token, update.message.text)
+        save_customer_phone(bot, str(update.message.chat_id), motlin_token, update.message.text, params['profiles'])
         show_customers_menu(bot, chat_id, motlin_token)
         delete_messages(bot, chat_id, update.message.message_id, 2)
         return 'HANDLE_CUSTOMERS'
@@ -200,8 +296,7 @@ def handle_waiting(bot, update, motlin_token, params):
     longitude, latitude = None, None
     if query and query.data == 'HANDLE_MENU':
         chat_id = query.message.chat_id
-        order_id = confirm_order(bot, chat_id, query.message.message_id)
-        params['redis_conn'].add_value(chat_id, 'order', order_id)
+        confirm_order(bot, chat_id, params['checkout'], delete_message_id=query.message.message_id)
         return query.data
     elif query and query.data == 'HANDLE_WAITING':
         bot.send_message(chat_id=query.message.chat_id, text='Пришлите, пожалуйста, Ваш адрес или геолокацию')
@@ -218,11 +313,12 @@ def handle_waiting(bot, update, motlin_token, params):
     if not longitude == latitude is None:
         chat_id = update.message.chat_id
         nearest_address = find_nearest_address(motlin_token, longitude, latitude)
-        params['redis_conn'].add_value(chat_id, 'nearest_pizzeria', nearest_address['address'])
+        params['session'].add_value(chat_id, 'nearest_pizzeria', nearest_address['address'])
         choose_deliviry(bot, chat_id, motlin_token, nearest_address)
         save_customer_address(
             bot, str(chat_id), motlin_token, customer_address, longitude, latitude,
-            geo_lib.fetch_address_decryption(params['ya_api_key'], longitude, latitude)
+            geo_lib.fetch_address_decryption(params['ya_api_key'], longitude, latitude),
+            params['profiles']
         )
         return 'HANDLE_DELIVERY'
     else:
@@ -239,22 +335,25 @@ def handle_delivery(bot, update, motlin_token, params, customer_chat_id=''):
     elif update.message:
         query, chat_id, message_id = None, update.message.chat_id, 0
 
-    pizzeria_address = motlin_lib.get_address(
-        motlin_token, 'pizzeria', 'address',
-        params['redis_conn'].get_value(chat_id, 'nearest_pizzeria')
+    nearest_pizzeria, delivery_type, delivery_price, cash_payment, delivery_time = params['session'].get_values(
+        chat_id, 'nearest_pizzeria', 'delivery_type', 'delivery_price', 'cash_payment', 'delivery_time'
     )
-    delivery_type = params['redis_conn'].get_value(chat_id, 'delivery_type')
-    delivery_price = params['redis_conn'].get_value(chat_id, 'delivery_price')
-    pay_by_cash = bool(params['redis_conn'].get_value(chat_id, 'cash_payment'))
+    pizzeria_address = motlin_lib.get_address(motlin_token, 'pizzeria', 'address', nearest_pizzeria)
+    pay_by_cash = bool(cash_payment)
 
     if query and 'COURIER_DELIVERY' in query.data:
         delivery_price = query.data.replace('COURIER_DELIVERY', '')
-        params['redis_conn'].add_value(chat_id, 'delivery_type', 'COURIER_DELIVERY')
-        params['redis_conn'].add_value(chat_id, 'delivery_price', int(delivery_price if delivery_price else 0))
-        params['job'].run_once(show_reminder, CLIENT_REMINDER_PERIOD, context=chat_id)
+        params['session'].add_values(chat_id, {
+            'delivery_type': 'COURIER_DELIVERY',
+            'delivery_price': int(delivery_price if delivery_price else 0)
+        })
+        params['scheduler'].schedule(
+            f'reminder:{chat_id}', 'show_reminder',
+            CLIENT_REMINDER_PERIOD, context=chat_id, chat_id=chat_id
+        )
         delete_messages(bot, chat_id, message_id, message_numbers=2)
     elif query and pizzeria_address and query.data == 'PICKUP_DELIVERY':
-        params['redis_conn'].add_value(chat_id, 'delivery_type', 'PICKUP_DELIVERY')
+        params['session'].add_value(chat_id, 'delivery_type', 'PICKUP_DELIVERY')
         bot.send_location(chat_id=chat_id, latitude=pizzeria_address['latitude'], longitude=pizzeria_address['longitude'])
         bot.send_message(
             chat_id=chat_id,
@@ -262,25 +361,15 @@ def handle_delivery(bot, update, motlin_token, params, customer_chat_id=''):
         delete_messages(bot, chat_id, message_id, message_numbers=2)
     elif pizzeria_address and delivery_type == 'COURIER_DELIVERY':
         courier_id = pizzeria_address['telegramid']
-        params['job'].run_repeating(
-            send_or_update_courier_messages,
-            COURIER_REMINDER_PERIOD,
-            first=0,
-            context={
-                'chat_id': chat_id,
-                'courier_id': courier_id,
-                'motlin_token': motlin_token,
-                'customer_address': motlin_lib.get_address(
-                    motlin_token, 'customeraddress',
-                    'customerid', str(chat_id)
-                ),
-                'delivery_price': delivery_price,
-                'cash': pay_by_cash,
-                'redis_conn': params['redis_conn'],
-                'delivery_time': get_delivery_time(params['redis_conn'], chat_id, CLIENT_REMINDER_PERIOD)
-            }
+        register_courier_delivery(
+            params['redis_conn'], chat_id, courier_id,
+            motlin_lib.get_customer_profile(motlin_token, chat_id),
+            delivery_price, pay_by_cash,
+            get_delivery_time(delivery_time, CLIENT_REMINDER_PERIOD),
+            motlin_lib.get_payment_info(motlin_token, str(chat_id))
         )
-        params['redis_conn'].add_value(courier_id, 'state', 'UPDATE_HANDLER')
+        params['scheduler'].schedule(f'courier:{chat_id}', 'update_courier_messages', 0, chat_id=chat_id)
+        params['session'].add_value(courier_id, 'state', 'UPDATE_HANDLER')
         return 'UPDATE_HANDLER'
     else:
         return 'HANDLE_DELIVERY'
@@ -291,31 +380,27 @@ def handle_delivery(bot, update, motlin_token, params, customer_chat_id=''):
 def handle_payment(bot, update, motlin_token, params):
     if update.message and update.message.successful_payment:
         chat_id = update.message.chat_id
-        order_id = confirm_order(bot, chat_id, motlin_token)
-        params['redis_conn'].add_value(chat_id, 'order', order_id)
-        delivery_type = params['redis_conn'].get_value(chat_id, 'delivery_type')
+        confirm_order(bot, chat_id, params['checkout'])
+        delivery_type = params['session'].get_value(chat_id, 'delivery_type')
         if delivery_type == 'PICKUP_DELIVERY':
-            motlin_lib.confirm_order_shipping(motlin_token, order_id)
-            motlin_lib.delete_the_cart(motlin_token, chat_id)
+            params['checkout'].finish(chat_id)
             clear_settings_and_task_queue(chat_id, params)
         else:
             handle_delivery(bot, update, motlin_token, params)
         return 'UPDATE_HANDLER'
     elif update.callback_query and update.callback_query.data == 'CASH_PAYMENT':
         chat_id = update.callback_query.message.chat_id
-        order_id = confirm_order(bot, chat_id, motlin_token, True, update.callback_query.message.message_id)
-        params['redis_conn'].add_value(chat_id, 'order', order_id)
-        params['redis_conn'].add_value(chat_id, 'cash_payment', 1)
+        confirm_order(bot, chat_id, params['checkout'], True, update.callback_query.message.message_id)
+        params['session'].add_value(chat_id, 'cash_payment', 1)
         handle_delivery(bot, update, motlin_token, params)
-        delivery_type = params['redis_conn'].get_value(chat_id, 'delivery_type')
+        delivery_type = params['session'].get_value(chat_id, 'delivery_type')
         if delivery_type == 'PICKUP_DELIVERY':
-            motlin_lib.confirm_order_shipping(motlin_token, order_id)
-            motlin_lib.delete_the_cart(motlin_token, chat_id)
+            params['checkout'].finish(chat_id)
             clear_settings_and_task_queue(chat_id, params)
         return 'UPDATE_HANDLER'
     elif update.callback_query and update.callback_query.data == 'CARD_PAYMENT':
         chat_id = update.callback_query.message.chat_id
-        params['redis_conn'].add_value(chat_id, 'cash_payment', 0)
+        params['session'].add_value(chat_id, 'cash_payment', 0)
         description, currency, price = motlin_lib.get_payment_info(motlin_token, chat_id)
         bot.send_invoice(
             chat_id, 'Оплата заказа',
@@ -348,12 +433,8 @@ def update_handler(bot, update, motlin_token, params):
     chat_id = query.message.chat_id
     if 'DELIVEREDYES' in query.data:
         customer_chat_id = query.data.replace('DELIVEREDYES', '')
-        motlin_lib.confirm_order_shipping(
-            motlin_token,
-            params['redis_conn'].get_value(customer_chat_id, 'order')
-        )
+        params['checkout'].finish(customer_chat_id)
         delete_messages(bot, chat_id, query.message.message_id)
-        motlin_lib.delete_the_cart(motlin_token, customer_chat_id)
         clear_settings_and_task_queue(chat_id, params)
         clear_settings_and_task_queue(customer_chat_id, params)
         return 'UPDATE_HANDLER'
@@ -364,27 +445,20 @@ def update_handler(bot, update, motlin_token, params):
             query.message.message_id
         )
     else:
-        send_courier_message(
-            bot, [
-                query.data, chat_id, motlin_token,
-                motlin_lib.get_address(motlin_token, 'customeraddress', 'customerid', query.data),
-                params['redis_conn'].get_value(query.data, 'delivery_price'),
-                bool(params['redis_conn'].get_value(query.data, 'cash_payment')),
-                params['redis_conn'],
-                get_delivery_time(params['redis_conn'], query.data, CLIENT_REMINDER_PERIOD)
-            ]
-        )
+        resend_courier_message(bot, params['redis_conn'], query.data)
         delete_messages(bot, chat_id, query.message.message_id)
     return 'UPDATE_HANDLER'
 
 
-def launch_store_bot(states_functions):
+def launch_store_bot(states_functions, replicas, replica_index):
     try:
         redis_conn = redis_lib.RedisDb(
             os.getenv('REDIS_HOST'),
             os.getenv('REDIS_PORT'),
             os.getenv('REDIS_PASSWORD')
         )
+        motlin_lib.initialize_cache(redis_conn)
+        geo_lib.initialize_cache(redis_conn)
         bot = TgDialogBot(
             os.getenv('TG_ACCESS_TOKEN'),
             states_functions,
@@ -393,12 +467,15 @@ def launch_store_bot(states_functions):
             motlin_client_secret=os.getenv('MOLTIN_CLIENT_SECRET'),
             ya_api_key=os.getenv('YANDEX_API_KEY'),
             payment_token=os.getenv('PAYMENT_TOKEN'),
-            heroku_url=os.getenv('HEROKU_URL')
+            heroku_url=os.getenv('HEROKU_URL'),
+            dispatch_workers=int(os.getenv('DISPATCH_WORKERS', dispatch_lib.DISPATCH_WORKERS)),
+            replicas=replicas,
+            replica_index=replica_index
         )
         bot.start()
     except Exception as error:
         logger.exception(f'Ошибка бота: {error}')
-        launch_store_bot(states_functions)
+        launch_store_bot(states_functions, replicas, replica_index)
 
 
 def main():
@@ -425,7 +502,9 @@ def main():
         'UPDATE_HANDLER': update_handler
     }
 
-    launch_store_bot(states_functions)
+    replicas = int(os.getenv('REPLICAS', 1))
+    replica_index = replica_lib.get_local_replica_index(replicas, os.getenv('DYNO'), os.getenv('REPLICA_INDEX'))
+    launch_store_bot(states_functions, replicas, replica_index)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,33 @@
 
 from libs import geo_lib
 from libs import motlin_lib
+import json
+import logging
 import textwrap
+import time
 
 from datetime import datetime, timedelta
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
 
 LIMIT_PRODS_PER_PAGE = 5
+DELIVERIES_KEY = 'deliveries'
+COURIER_MESSAGES_KEY = 'deliveries:messages'
+
+pizzeria_index = geo_lib.SpatialIndex()
+menu_layouts = {}
+
+logger = logging.getLogger('pizza_delivery_bot')
 
 
 def clear_settings_and_task_queue(chat_id, params):
-    params['redis_conn'].del_value(chat_id)
-    for job in params['job'].jobs():
-        job.schedule_removal()
+    params['session'].del_value(chat_id)
+    params['session'].del_key(DELIVERIES_KEY, chat_id)
+    params['session'].del_key(COURIER_MESSAGES_KEY, chat_id)
+    params['scheduler'].remove_chat_jobs(chat_id)
 
 
-def get_delivery_time(redis_conn, chat_id, end_of_period):
-    delivery_time = redis_conn.get_value(chat_id, 'delivery_time')
+def get_delivery_time(delivery_time, end_of_period):
     if not delivery_time:
         return datetime.now() + timedelta(seconds=end_of_period)
     else:
@@ -30,36 +41,57 @@ def delete_messages(bot, chat_id, message_id, message_numbers=1):
         bot.delete_message(chat_id=chat_id, message_id=int(message_id) - offset_id)
 
 
+def get_menu_navigation(page, max_pages):
+    if max_pages == 1:
+        return []
+    if page > 1 and page < max_pages:
+        return [[
+            InlineKeyboardButton('Пред.', callback_data='%d' % (page - 1)),
+            InlineKeyboardButton('След.', callback_data='%d' % (page + 1))
+        ]]
+    elif page == 1:
+        return [[InlineKeyboardButton('След.', callback_data='%d' % (page + 1))]]
+    return [[InlineKeyboardButton('Пред.', callback_data='%d' % (page - 1))]]
+
+
+def get_menu_layout(access_token, page=None):
+    page = int(page) if page else 1
+    version = motlin_lib.catalog_cache.get_version()
+    layout_key = (version, page, LIMIT_PRODS_PER_PAGE)
+    menu_layout = menu_layouts.get(layout_key)
+    if menu_layout and menu_layout['expires'] > time.time():
+        return menu_layout
+    all_products, max_pages, current_page = motlin_lib.get_products(
+        access_token, LIMIT_PRODS_PER_PAGE * (page - 1), LIMIT_PRODS_PER_PAGE
+    )
+    menu_layout = {
+        'expires': time.time() + motlin_lib.CATALOG_CACHE_TTL,
+        'products': [
+            (product['id'], product['name'], [InlineKeyboardButton(product['name'] + ' ', callback_data=product['id'])])
+            for product in all_products
+        ],
+        'navigation': get_menu_navigation(current_page, max_pages)
+    }
+    for outdated_key in [key for key in list(menu_layouts) if key[0] != version]:
+        menu_layouts.pop(outdated_key, None)
+    menu_layouts[layout_key] = menu_layout
+    return menu_layout
+
+
 def get_store_menu(access_token, chat_id, page=None):
-    offset = LIMIT_PRODS_PER_PAGE * (int(page) - 1 if page else 0)
-    all_products, max_pages, page = motlin_lib.get_products(access_token, offset, LIMIT_PRODS_PER_PAGE)
+    menu_layout = get_menu_layout(access_token, page)
     products_in_cart = {
         cart_item['product_id']: cart_item['quantity']
         for cart_item in motlin_lib.get_cart_items(access_token, chat_id)
     }
     keyboard = [
         [InlineKeyboardButton(
-            '%s %s' % (
-                products['name'], '({} шт.)'.format(products_in_cart[products['id']]) if products_in_cart.get(products['id']) else ''
-            ), callback_data=products['id']
-        )] for products in all_products
+            '%s (%s шт.)' % (product_name, products_in_cart[product_id]), callback_data=product_id
+        )] if products_in_cart.get(product_id) else product_row
+        for product_id, product_name, product_row in menu_layout['products']
     ]
     keyboard.append([InlineKeyboardButton('Корзина', callback_data=chat_id)])
-    if max_pages == 1:
-        return InlineKeyboardMarkup(keyboard)
-    if page > 1 and page < max_pages:
-        keyboard.append([
-            InlineKeyboardButton('Пред.', callback_data='%d' % (page - 1)),
-            InlineKeyboardButton('След.', callback_data='%d' % (page + 1))
-        ])
-    elif page == 1:
-        keyboard.append([
-            InlineKeyboardButton('След.', callback_data='%d' % (page + 1))
-        ])
-    elif page >= max_pages:
-        keyboard.append([
-            InlineKeyboardButton('Пред.', callback_data='%d' % (page - 1))
-        ])
+    keyboard.extend(menu_layout['navigation'])
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -135,16 +167,30 @@ def show_store_menu(bot, chat_id, motlin_token, delete_message_id=0, page=None):
     delete_messages(bot, chat_id, delete_message_id)
 
 
-def show_product_card(bot, chat_id, motlin_token, product_id, delete_message_id=0):
-    product_caption, product_image = motlin_lib.get_product_info(motlin_token, product_id)
-    reply_markup = get_product_card_menu(motlin_token, chat_id, product_id)
-    bot.send_photo(
+def send_product_photo(bot, chat_id, photo, caption, reply_markup):
+    return bot.send_photo(
         chat_id=chat_id,
-        photo=product_image,
-        caption=product_caption,
+        photo=photo,
+        caption=caption,
         reply_markup=reply_markup,
         parse_mode='html'
     )
+
+
+def show_product_card(bot, chat_id, motlin_token, product_id, delete_message_id=0):
+    product_caption, product_image, image_id = motlin_lib.get_product_info(motlin_token, product_id)
+    reply_markup = get_product_card_menu(motlin_token, chat_id, product_id)
+    file_id = motlin_lib.photo_cache.get(product_id, image_id)
+    if file_id:
+        try:
+            send_product_photo(bot, chat_id, file_id, product_caption, reply_markup)
+            delete_messages(bot, chat_id, delete_message_id)
+            return
+        except BadRequest:
+            motlin_lib.photo_cache.delete(product_id)
+    message = send_product_photo(bot, chat_id, product_image, product_caption, reply_markup)
+    if message.photo:
+        motlin_lib.photo_cache.set(product_id, image_id, message.photo[-1].file_id)
     delete_messages(bot, chat_id, delete_message_id)
 
 
@@ -168,7 +214,7 @@ def show_products_in_cart(bot, chat_id, motlin_token, delete_message_id=0):
 
 
 def show_customers_menu(bot, chat_id, motlin_token, delete_message_id=0):
-    customer_address = motlin_lib.get_address(motlin_token, 'customeraddress', 'customerid', str(chat_id))
+    customer_address = motlin_lib.get_customer_profile(motlin_token, chat_id)
     if customer_address:
         reply_markup = get_customers_menu(motlin_token, chat_id, customer_address['telephone'] and customer_address['email'])
     else:
@@ -181,45 +227,38 @@ def show_customers_menu(bot, chat_id, motlin_token, delete_message_id=0):
     delete_messages(bot, chat_id, delete_message_id)
 
 
-def find_nearest_address(motlin_token, longitude, latitude):
+def refresh_pizzeria_index(motlin_token):
     addresses = motlin_lib.get_pizzeria_entries(motlin_token)
-    geo_lib.calculate_distance(addresses, longitude, latitude)
-    return min(addresses, key=lambda address: address['distance'])
+    if geo_lib.get_fingerprint(addresses) != pizzeria_index.fingerprint:
+        pizzeria_index.rebuild(addresses)
 
 
-def save_customer_phone(bot, chat_id, motlin_token, customer_phone):
-    motlin_lib.save_address(
-        motlin_token, 'customeraddress',
-        'customerid', chat_id,
-        address={
-            'telephone': customer_phone,
-            'customerid': chat_id
-        }
-    )
+def update_pizzeria_index(bot, job):
+    refresh_pizzeria_index(job.context.get_token())
 
 
-def save_customer_email(bot, chat_id, motlin_token, customer_phone):
-    motlin_lib.save_address(
-        motlin_token, 'customeraddress',
-        'customerid', chat_id,
-        address={
-            'email': customer_phone,
-            'customerid': chat_id
-        }
-    )
+def find_nearest_address(motlin_token, longitude, latitude):
+    if not pizzeria_index.size:
+        refresh_pizzeria_index(motlin_token)
+    return pizzeria_index.nearest(longitude, latitude)[0]
+
+
+def save_customer_phone(bot, chat_id, motlin_token, customer_phone, profile_buffer):
+    profile_buffer.save(motlin_token, chat_id, {'telephone': customer_phone})
+
 
+def save_customer_email(bot, chat_id, motlin_token, customer_phone, profile_buffer):
+    profile_buffer.save(motlin_token, chat_id, {'email': customer_phone})
 
-def save_customer_address(bot, chat_id, motlin_token, customer_address, longitude, latitude, address_decryption):
-    motlin_lib.save_address(
-        motlin_token,
-        'customeraddress',
-        'customerid',
-        chat_id,
-        address={
+
+def save_customer_address(bot, chat_id, motlin_token, customer_address, longitude, latitude,
+                          address_decryption, profile_buffer):
+    profile_buffer.save(
+        motlin_token, chat_id,
+        {
             'address': customer_address,
             'longitude': longitude,
             'latitude': latitude,
-            'customerid': chat_id,
             'country': address_decryption['CountryName'],
             'county': address_decryption['AdministrativeAreaName'],
             'city': address_decryption['LocalityName']
@@ -277,68 +316,96 @@ def confirm_deliviry(bot, chat_id, customer_chat_id, delete_message_id=0):
     delete_messages(bot, chat_id, delete_message_id, 2)
 
 
-def send_or_update_courier_messages(bot, job):
-    params_of_courier_messages = [value for value in job.context.values()]
-    message_id = job.context['redis_conn'].get_value(job.context['courier_id'], job.context['chat_id'])
-    if message_id:
-        update_courier_message(bot, message_id, job, params_of_courier_messages)
-    else:
-        send_courier_message(bot, params_of_courier_messages)
-
-
-def update_courier_message(bot, message_id, job, params_of_courier_message):
-    chat_id, delivery_chat_id, motlin_token, customer_address, \
-        delivery_price, cash, redis_conn, delivery_time = params_of_courier_message
-    rest_of_delivery_time = int((delivery_time - datetime.now()).seconds / 60)
-    reply_markup = get_courier_menu(motlin_token, chat_id)
-    cart_info, currency, amount = motlin_lib.get_payment_info(motlin_token, str(chat_id))
+def register_courier_delivery(redis_conn, chat_id, courier_id, customer_address,
+                              delivery_price, cash, delivery_time, payment_info):
+    cart_info, currency, amount = payment_info
+    redis_conn.add_value(DELIVERIES_KEY, chat_id, json.dumps({
+        'chat_id': chat_id,
+        'courier_id': courier_id,
+        'latitude': customer_address['latitude'],
+        'longitude': customer_address['longitude'],
+        'delivery_price': delivery_price,
+        'cash': cash,
+        'delivery_time': delivery_time.timestamp(),
+        'cart_info': cart_info,
+        'currency': currency,
+        'amount': amount
+    }))
+
+
+def get_courier_message(delivery):
+    rest_of_delivery_time = int((delivery['delivery_time'] - datetime.now().timestamp()) / 60)
+    currency = delivery['currency']
     if rest_of_delivery_time > 0:
-        message = '\n'.join(
+        return '\n'.join(
             [
-                cart_info,
-                f'Сумма заказа: {amount} {currency}',
-                f'Доставка {delivery_price} {currency}' if delivery_price else '',
-                'Наличными при получении' if cash else '',
+                delivery['cart_info'],
+                f'Сумма заказа: {delivery["amount"]} {currency}',
+                f'Доставка {delivery["delivery_price"]} {currency}' if delivery['delivery_price'] else '',
+                'Наличными при получении' if delivery['cash'] else '',
                 f'Доставить через {rest_of_delivery_time} минут'
             ]
         )
-    else:
-        message = '\n'.join(
-            [
-                cart_info,
-                f'Сумма заказа: {amount} {currency}',
-                'Доставка просрочена'
-            ]
-        )
-        job.schedule_removal()
-    bot.edit_message_text(
-        chat_id=delivery_chat_id, message_id=int(message_id),
-        text=message, reply_markup=reply_markup
-    )
-
-
-def send_courier_message(bot, params_of_courier_message):
-    chat_id, delivery_chat_id, motlin_token, customer_address, \
-        delivery_price, cash, redis_conn, delivery_time = params_of_courier_message
-    rest_of_delivery_time = int((delivery_time - datetime.now()).seconds / 60)
-    bot.send_location(chat_id=delivery_chat_id, latitude=customer_address['latitude'], longitude=customer_address['longitude'])
-    reply_markup = get_courier_menu(motlin_token, chat_id)
-    cart_info, currency, amount = motlin_lib.get_payment_info(motlin_token, str(chat_id))
-    message = '\n'.join(
+    return '\n'.join(
         [
-            cart_info,
-            f'Сумма заказа: {amount} {currency}',
-            f'Доставка {delivery_price} {currency}' if delivery_price else '',
-            'Наличными при получении' if cash else '',
-            f'Доставить через {rest_of_delivery_time} минут'
+            delivery['cart_info'],
+            f'Сумма заказа: {delivery["amount"]} {currency}',
+            'Доставка просрочена'
         ]
     )
+
+
+def update_courier_messages(bot, redis_conn):
+    deliveries = [json.loads(delivery) for delivery in redis_conn.get_all(DELIVERIES_KEY).values()]
+    courier_messages = redis_conn.get_all(COURIER_MESSAGES_KEY)
+    with redis_conn.pipeline(execute_on_error=True) as pipeline:
+        for chat_id in set(courier_messages) - {str(delivery['chat_id']) for delivery in deliveries}:
+            pipeline.del_key(COURIER_MESSAGES_KEY, chat_id)
+        for delivery in deliveries:
+            courier_message = courier_messages.get(str(delivery['chat_id']))
+            try:
+                courier_message = update_courier_message(bot, delivery['courier_id'], delivery, courier_message)
+            except TelegramError as error:
+                logger.warning(f'Не удалось обновить сообщение курьеру {delivery["courier_id"]}: {error}')
+                continue
+            if courier_message:
+                pipeline.add_value(COURIER_MESSAGES_KEY, delivery['chat_id'], json.dumps(courier_message))
+
+
+def update_courier_message(bot, courier_id, delivery, courier_message):
+    if not courier_message:
+        return send_courier_message(bot, delivery)
+    courier_message = json.loads(courier_message)
+    message = get_courier_message(delivery)
+    if not courier_message['message_id'] or message == courier_message['text']:
+        return None
+    try:
+        bot.edit_message_text(
+            chat_id=courier_id, message_id=courier_message['message_id'],
+            text=message, reply_markup=get_courier_menu(None, delivery['chat_id'])
+        )
+    except BadRequest as error:
+        if 'not modified' not in str(error):
+            courier_message['message_id'] = None
+    courier_message['text'] = message
+    return courier_message
+
+
+def send_courier_message(bot, delivery):
+    bot.send_location(chat_id=delivery['courier_id'], latitude=delivery['latitude'], longitude=delivery['longitude'])
+    message = get_courier_message(delivery)
     sended_message = bot.send_message(
-        chat_id=delivery_chat_id,
-        text=message, reply_markup=reply_markup
+        chat_id=delivery['courier_id'],
+        text=message, reply_markup=get_courier_menu(None, delivery['chat_id'])
     )
-    redis_conn.add_value(delivery_chat_id, chat_id, sended_message.message_id)
-    redis_conn.add_value(chat_id, 'delivery_time', delivery_time.timestamp())
+    return {'message_id': sended_message.message_id, 'text': message}
+
+
+def resend_courier_message(bot, redis_conn, chat_id):
+    delivery = redis_conn.get_value(DELIVERIES_KEY, chat_id)
+    if delivery:
+        courier_message = send_courier_message(bot, json.loads(delivery))
+        redis_conn.add_value(COURIER_MESSAGES_KEY, chat_id, json.dumps(courier_message))
 
 
 def choose_payment_type(bot, chat_id, delete_message_id=0):
@@ -353,14 +420,20 @@ def show_reminder(bot, job):
     bot.send_message(chat_id=job.context, text=message)
 
 
-def confirm_order(bot, chat_id, motlin_token, cash_payment=False, delete_message_id=0):
-    order_id = motlin_lib.create_order(motlin_token, chat_id)
-    if order_id:
-        transaction_id = motlin_lib.set_order_payment(motlin_token, order_id)
-        motlin_lib.confirm_order_payment(motlin_token, order_id, transaction_id)
+def confirm_order(bot, chat_id, checkout_pipeline, cash_payment=False, delete_message_id=0):
+    checkout_pipeline.enqueue(chat_id, cash_payment)
     if cash_payment:
-        bot.send_message(chat_id=chat_id, text='Благодарим! Ваш заказ изготавливается.')
+        bot.send_message(chat_id=chat_id, text='Благодарим! Ваш заказ принят и изготавливается.')
     else:
-        bot.send_message(chat_id=chat_id, text='Благодарим за оплату! Ваш заказ изготавливается.')
+        bot.send_message(chat_id=chat_id, text='Благодарим за оплату! Ваш заказ принят и изготавливается.')
     delete_messages(bot, chat_id, delete_message_id)
-    return order_id
+
+
+def notify_order_confirmed(bot, chat_id, order_id, failed=False):
+    if failed:
+        bot.send_message(
+            chat_id=chat_id,
+            text='Не удалось оформить заказ. Мы продолжаем попытки и сообщим, как только заказ будет оформлен.'
+        )
+    else:
+        bot.send_message(chat_id=chat_id, text=f'Заказ {order_id} оформлен.')